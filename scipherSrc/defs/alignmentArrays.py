@@ -0,0 +1,180 @@
+import os
+import json
+
+import numpy as np
+
+from scipherSrc.defs.compressedIO import openInput
+
+class AlignmentArrays(object):
+    """Struct-of-arrays table of read alignments.
+    contigs   : list of contig names; contigCodes index into it (int32)
+    starts    : int64 start coords
+    stops     : int64 stop coords (start+len-1, as in the parsers' _parseCoords)
+    strands   : bool, True == forward/'+'
+    readData  : uint8 array holding every read seq back to back
+    readOffsets: int64 array (len(starts)+1); read i is readData[readOffsets[i]:readOffsets[i+1]]
+    """
+    _arrayNames = ('contigCodes','starts','stops','strands','readData','readOffsets')
+
+    def __init__(self,contigs,contigCodes,starts,stops,strands,readData=None,readOffsets=None):
+        self.contigs     = list(contigs)
+        self.contigCodes = contigCodes
+        self.starts      = starts
+        self.stops       = stops
+        self.strands     = strands
+        if readData is None:
+            readData    = np.zeros(0, dtype=np.uint8)
+            readOffsets = np.zeros(len(starts)+1, dtype=np.int64)
+        self.readData    = readData
+        self.readOffsets = readOffsets
+
+    def __len__(self):
+        return len(self.starts)
+
+    def contigOf(self,i):
+        return self.contigs[self.contigCodes[i]]
+
+    def coords(self,i):
+        """Returns t(contig,start,stop) for alignment <i>, as _parseCoords does."""
+        return (self.contigs[self.contigCodes[i]],int(self.starts[i]),int(self.stops[i]))
+
+    def readSeq(self,i):
+        return self.readData[self.readOffsets[i]:self.readOffsets[i+1]].tostring()
+
+    def contigMask(self,contig):
+        """Returns bool array selecting alignments on <contig>."""
+        try:
+            code = self.contigs.index(contig)
+        except ValueError:
+            return np.zeros(len(self), dtype=bool)
+        return self.contigCodes == code
+
+    def save(self,dirPath,source=None):
+        """Writes one .npy file per array plus contigs.txt into <dirPath>.
+        <source> (dict describing what the arrays were built from) is written
+        last to source.json, so its presence marks a complete save."""
+        if not os.path.isdir(dirPath):
+            os.makedirs(dirPath)
+        sourcePath = os.path.join(dirPath, 'source.json')
+        if os.path.exists(sourcePath):
+            os.remove(sourcePath)
+        # -- write-then-rename so arrays still memory-mapped from an old save stay valid --
+        for name in self._arrayNames:
+            tmpPath = os.path.join(dirPath, '%s.%s.tmp.npy' % (name,os.getpid()))
+            np.save(tmpPath, getattr(self,name))
+            os.rename(tmpPath, os.path.join(dirPath, name + '.npy'))
+        ctgFile = open(os.path.join(dirPath, 'contigs.txt'), 'w')
+        for ctg in self.contigs:
+            ctgFile.write('%s\n' % (ctg))
+        ctgFile.close()
+        if source is not None:
+            tmpPath = '%s.%s.tmp' % (sourcePath,os.getpid())
+            srcFile = open(tmpPath, 'w')
+            json.dump(source, srcFile, sort_keys=True)
+            srcFile.close()
+            os.rename(tmpPath, sourcePath)
+
+    @staticmethod
+    def savedSource(dirPath):
+        """Returns the <source> dict written by save(), or None."""
+        try:
+            return json.load(open(os.path.join(dirPath, 'source.json')))
+        except (IOError,ValueError):
+            return None
+
+    @classmethod
+    def load(cls,dirPath,mmap=True):
+        """Loads a table written by save(); arrays are memory-mapped if <mmap>."""
+        mode = 'r' if mmap else None
+        arrays = [np.load(os.path.join(dirPath, name + '.npy'), mmap_mode=mode) for name in cls._arrayNames]
+        contigs = [x.rstrip('\n') for x in open(os.path.join(dirPath, 'contigs.txt'))]
+        contigCodes,starts,stops,strands,readData,readOffsets = arrays
+        return cls(contigs,contigCodes,starts,stops,strands,readData,readOffsets)
+
+
+def _loadAlignments(filePath,colContig,colStart,colStrand,colRead,colLength,plusSymbols,
+                    withReads,chunkBytes):
+    """Parses tab-delimited alignment lines in chunks of ~<chunkBytes> into an
+    AlignmentArrays.  Stop is start+len-1 where len is int(line[colLength]),
+    or the read length if colLength is None."""
+    alnFile = openInput(filePath)
+    ctgIdx  = {}
+    parts   = dict([(name,[]) for name in AlignmentArrays._arrayNames])
+    readEnd = 0
+    while 1:
+        lines = alnFile.readlines(chunkBytes)
+        if not lines:
+            break
+        rows = [line.rstrip('\n').split('\t') for line in lines if line.strip()]
+        if not rows:
+            continue
+        cols = zip(*rows)
+
+        # -- contigs: categorical codes, uniques of the chunk mapped to global codes --
+        uniq,inverse = np.unique(np.array(cols[colContig]), return_inverse=True)
+        globalCodes  = np.array([ctgIdx.setdefault(ctg,len(ctgIdx)) for ctg in uniq], dtype=np.int32)
+        parts['contigCodes'].append(globalCodes[inverse])
+
+        starts = np.array(cols[colStart]).astype(np.int64)
+        if colLength is None:
+            lengths = np.fromiter((len(x) for x in cols[colRead]), dtype=np.int64, count=len(rows))
+        else:
+            lengths = np.array(cols[colLength]).astype(np.int64)
+        parts['starts'].append(starts)
+        parts['stops'].append(starts + lengths - 1)
+        parts['strands'].append(np.in1d(np.array(cols[colStrand]), plusSymbols))
+
+        if withReads:
+            readLens = np.fromiter((len(x) for x in cols[colRead]), dtype=np.int64, count=len(rows))
+            parts['readData'].append(np.frombuffer(''.join(cols[colRead]), dtype=np.uint8))
+            parts['readOffsets'].append(readEnd + np.cumsum(readLens))
+            readEnd += int(readLens.sum())
+    alnFile.close()
+
+    def cat(name,dtype):
+        if parts[name]:
+            return np.concatenate(parts[name])
+        return np.zeros(0, dtype=dtype)
+    contigs = sorted(ctgIdx, key=ctgIdx.get)
+    readData = readOffsets = None
+    if withReads:
+        readData    = cat('readData',np.uint8)
+        readOffsets = np.concatenate(([0],cat('readOffsets',np.int64))).astype(np.int64)
+    return AlignmentArrays(contigs,cat('contigCodes',np.int32),cat('starts',np.int64),
+                           cat('stops',np.int64),cat('strands',bool),readData,readOffsets)
+
+def _sourceInfo(filePath,loaderName,withReads):
+    st = os.stat(filePath)
+    return {'path':os.path.abspath(filePath),
+            'size':st.st_size,
+            'mtime':st.st_mtime,
+            'loader':loaderName,
+            'withReads':bool(withReads)}
+
+def _cachedLoad(loaderName,filePath,cacheDir,**kwargs):
+    """Loads <filePath> with _loadAlignments(**kwargs), reusing <cacheDir> only
+    if its source.json matches this file (abs path, size, mtime), loader and
+    withReads exactly; otherwise re-parses and rewrites the cache."""
+    if not cacheDir:
+        return _loadAlignments(filePath,**kwargs)
+    source = _sourceInfo(filePath,loaderName,kwargs['withReads'])
+    if AlignmentArrays.savedSource(cacheDir) == source:
+        return AlignmentArrays.load(cacheDir)
+    alns = _loadAlignments(filePath,**kwargs)
+    alns.save(cacheDir,source=source)
+    return alns
+
+def loadBowtieMap(filePath,withReads=True,chunkBytes=16*1024*1024,cacheDir=None):
+    """Returns AlignmentArrays for a bowtie.map file (see ParseBowtieMap).
+    If <cacheDir> is given, the parsed arrays are saved there and later calls
+    memory-map them instead of re-parsing (the cache is rebuilt unless it was
+    built from this same file -- path, size and mtime -- with the same
+    <withReads>)."""
+    return _cachedLoad('loadBowtieMap',filePath,cacheDir,colContig=2,colStart=3,colStrand=1,
+                       colRead=4,colLength=None,plusSymbols=['+'],withReads=withReads,chunkBytes=chunkBytes)
+
+def loadSolexaSorted(filePath,withReads=True,chunkBytes=16*1024*1024,cacheDir=None):
+    """Returns AlignmentArrays for a solexa x_sorted.txt file (see ParseSolexaSorted).
+    <cacheDir> works as in loadBowtieMap."""
+    return _cachedLoad('loadSolexaSorted',filePath,cacheDir,colContig=11,colStart=12,colStrand=13,
+                       colRead=8,colLength=14,plusSymbols=['F','+'],withReads=withReads,chunkBytes=chunkBytes)
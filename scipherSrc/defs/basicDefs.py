@@ -1,7 +1,14 @@
+import collections
+import itertools
+
+import numpy as np
+
 def slidingWindow(sequence,winSize,step=1):
     """Returns a generator that will iterate through
     the defined chunks of input sequence.  Input sequence
-    must be iterable."""
+    must be iterable.
+    Sequences without a len() (eg. generators, file streams) are
+    handled by streamingWindow and yield tuples instead of slices."""
     
     # Verify the inputs
     try: it = iter(sequence)
@@ -11,12 +18,82 @@ def slidingWindow(sequence,winSize,step=1):
         raise Exception("**ERROR** type(winSize) and type(step) must be int.")
     if step > winSize:
         raise Exception("**ERROR** step must not be larger than winSize.")
+    if not hasattr(sequence,'__len__'):
+        return streamingWindow(it,winSize,step)
     if winSize > len(sequence):
         raise Exception("**ERROR** winSize must not be larger than sequence length.")
-    
+    return _sliceWindows(sequence,winSize,step)
+
+def _sliceWindows(sequence,winSize,step):
     # Pre-compute number of chunks to emit
-    numOfChunks = ((len(sequence)-winSize)/step)+1
+    numOfChunks = ((len(sequence)-winSize)//step)+1
     
     # Do the work
     for i in range(0,numOfChunks*step,step):
         yield sequence[i:i+winSize]
+
+def streamingWindow(iterable,winSize,step=1):
+    """Yields tuples of <winSize> consecutive items from any iterable,
+    advancing <step> items each time.  Only the current window is held
+    (in a deque), so the input may be a stream of unknown length."""
+    it  = iter(iterable)
+    win = collections.deque(itertools.islice(it,winSize),maxlen=winSize)
+    if len(win) < winSize:
+        return
+    yield tuple(win)
+    while 1:
+        nxt = list(itertools.islice(it,step))
+        if len(nxt) < step:
+            return
+        win.extend(nxt)
+        yield tuple(win)
+
+def windowArray(sequence,winSize,step=1):
+    """Returns every window of <sequence> at once as a read-only 2D numpy
+    view (nWindows x winSize) that shares memory with the input: no
+    window is copied.  A str becomes a view of its bytes (uint8);
+    wrap rows with .tostring() if str windows are needed."""
+    if isinstance(sequence,str):
+        arr = np.frombuffer(sequence, dtype=np.uint8)
+    else:
+        arr = np.asarray(sequence)
+    if arr.ndim != 1:
+        raise Exception("**ERROR** sequence must be one dimensional.")
+    if winSize > len(arr) or winSize < 1 or step < 1:
+        raise Exception("**ERROR** need 1 <= winSize <= sequence length and step >= 1.")
+    numOfChunks = ((len(arr)-winSize)//step)+1
+    stride = arr.strides[0]
+    return np.lib.stride_tricks.as_strided(arr, shape=(numOfChunks,winSize),
+                                           strides=(stride*step,stride), writeable=False)
+
+def windowCodes(sequence,winSize,alphabet='ACGT'):
+    """Returns (codes,valid): one integer code per window of <sequence>
+    (rolling base-len(alphabet) hash; 2-bit shifts for DNA) and a bool array
+    that is False for windows holding symbols not in <alphabet>.
+    See seqEncoding.kmerCodes."""
+    from scipherSrc.defs.seqEncoding import encodeSeq,kmerCodes
+    if hasattr(sequence,'dnaCodes') and list(alphabet) == list('ACGT'):
+        symCodes = sequence.dnaCodes()
+    else:
+        symCodes = encodeSeq(sequence,alphabet)
+    return kmerCodes(symCodes,winSize,len(alphabet))
+
+def iterWindowCodes(iterable,winSize,alphabet='ACGT'):
+    """Streaming version of windowCodes: yields the integer code of each
+    window of a stream of symbols, keeping only a running hash.  Windows
+    containing unknown symbols are skipped."""
+    base   = len(alphabet)
+    symIdx = dict([(x,i) for i,x in enumerate(alphabet)])
+    top    = base**winSize
+    code   = 0
+    good   = 0   # number of valid symbols at the end of the current window
+    for sym in iterable:
+        i = symIdx.get(sym)
+        if i is None:
+            good = 0
+            code = 0
+            continue
+        code = (code*base + i) % top
+        good += 1
+        if good >= winSize:
+            yield code
@@ -0,0 +1,316 @@
+import os
+import bz2
+import zlib
+import stat
+import struct
+import Queue
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+GZIP_MAGIC = '\x1f\x8b'
+BZ2_MAGIC  = 'BZh'
+
+def sniffCompression(filePath):
+    """Returns 'bgzf', 'gzip', 'bz2' or None based on the file's magic bytes."""
+    f = open(filePath, 'rb')
+    head = f.read(18)
+    f.close()
+    return _sniffHead(head)
+
+def _sniffHead(head):
+    """Returns compression kind from the first 18 bytes of a file."""
+    if head.startswith(GZIP_MAGIC):
+        # -- BGZF == gzip member with FEXTRA set and a 'BC' subfield first --
+        if len(head) == 18 and ord(head[3]) & 4 and head[12:14] == 'BC':
+            return 'bgzf'
+        return 'gzip'
+    if head.startswith(BZ2_MAGIC):
+        return 'bz2'
+    return None
+
+
+# ++++ Chunk generators: yield decompressed strings from a raw file ++++
+
+def iterGzipChunks(rawFile,readSize=1024*1024):
+    """Yields decompressed chunks of a (possibly multi-member) gzip file."""
+    d = zlib.decompressobj(16+zlib.MAX_WBITS)
+    while 1:
+        data = rawFile.read(readSize)
+        if not data:
+            break
+        while data:
+            out = d.decompress(data)
+            if out:
+                yield out
+            data = d.unused_data
+            if data:
+                # -- member ended inside this chunk: start on the next one --
+                d = zlib.decompressobj(16+zlib.MAX_WBITS)
+    tail = d.flush()
+    if tail:
+        yield tail
+
+def iterBz2Chunks(rawFile,readSize=1024*1024):
+    """Yields decompressed chunks of a (possibly multi-stream) bz2 file."""
+    d = bz2.BZ2Decompressor()
+    while 1:
+        data = rawFile.read(readSize)
+        if not data:
+            break
+        while data:
+            try:
+                out = d.decompress(data)
+            except EOFError:
+                # -- previous stream ended exactly at a chunk boundary --
+                d = bz2.BZ2Decompressor()
+                continue
+            if out:
+                yield out
+            data = d.unused_data
+            if data:
+                d = bz2.BZ2Decompressor()
+
+def iterBgzfBlocks(rawFile):
+    """Yields the raw deflate payload of each BGZF block in <rawFile>."""
+    while 1:
+        head = rawFile.read(12)
+        if not head:
+            return
+        if len(head) < 12 or not head.startswith(GZIP_MAGIC):
+            raise Exception("**ERROR** corrupt BGZF block header.")
+        xlen  = struct.unpack('<H', head[10:12])[0]
+        extra = rawFile.read(xlen)
+        bsize = None
+        pos   = 0
+        while pos + 4 <= len(extra):
+            slen = struct.unpack('<H', extra[pos+2:pos+4])[0]
+            if extra[pos:pos+2] == 'BC':
+                bsize = struct.unpack('<H', extra[pos+4:pos+6])[0]
+            pos += 4 + slen
+        if bsize is None:
+            raise Exception("**ERROR** gzip member without a BGZF BC subfield.")
+        rest = rawFile.read(bsize + 1 - 12 - xlen)
+        yield rest[:-8]
+
+def _inflateBlocks(payloads):
+    return ''.join([zlib.decompress(p, -15) for p in payloads])
+
+def _batchBlocks(blocks,blocksPerTask):
+    batch = []
+    for b in blocks:
+        batch.append(b)
+        if len(batch) >= blocksPerTask:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def iterBgzfChunks(rawFile,threads=None,blocksPerTask=64):
+    """Yields decompressed chunks of a BGZF file, inflating batches of
+    independent blocks in parallel (zlib releases the GIL) while keeping
+    their order.  At most threads*2 batches are in flight, so memory stays
+    bounded however fast the consumer is."""
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    pool = ThreadPool(threads)
+    inFlight = collections.deque()
+    try:
+        for batch in _batchBlocks(iterBgzfBlocks(rawFile),blocksPerTask):
+            if len(inFlight) >= threads*2:
+                chunk = inFlight.popleft().get()
+                if chunk:
+                    yield chunk
+            inFlight.append(pool.apply_async(_inflateBlocks,(batch,)))
+        while inFlight:
+            chunk = inFlight.popleft().get()
+            if chunk:
+                yield chunk
+    finally:
+        pool.terminate()
+
+
+# ++++ File-like reader fed by a background thread ++++
+
+_EOF = object()
+
+class BackgroundReader(object):
+    """Read-only file-like object (read/readline/iteration) whose data is
+    produced by <chunkIter> in a background thread and handed over through
+    a queue of at most <maxChunks> chunks, so decompression and parsing
+    overlap while memory stays bounded."""
+    def __init__(self,chunkIter,maxChunks=8,universal=True,rawFile=None):
+        """<universal>: translate '\\r\\n' line ends to '\\n' (like open(...,'rU')).
+        <rawFile>: underlying file, closed by self.close()."""
+        self._queue = Queue.Queue(maxChunks)
+        self._universal = universal
+        self._rawFile = rawFile
+        self._buf = ''
+        self._pos = 0
+        self._carry = ''
+        self._done = False
+        self._stop = False
+        self.closed = False
+        self._thread = threading.Thread(target=self._produce, args=(chunkIter,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self,chunkIter):
+        try:
+            for chunk in chunkIter:
+                if self._stop:
+                    return
+                self._queue.put(chunk)
+            self._queue.put(_EOF)
+        except Exception, e:
+            self._queue.put(e)
+
+    def _nextChunk(self):
+        """Returns next chunk of text or '' at EOF."""
+        if self._done:
+            return ''
+        chunk = self._queue.get()
+        if chunk is _EOF:
+            self._done = True
+            chunk, self._carry = self._carry, ''
+            return chunk
+        if isinstance(chunk,Exception):
+            self._done = True
+            raise chunk
+        if self._universal:
+            chunk = self._carry + chunk
+            self._carry = ''
+            if chunk.endswith('\r'):
+                chunk, self._carry = chunk[:-1], '\r'
+            chunk = chunk.replace('\r\n','\n')
+            if not chunk:
+                return self._nextChunk()
+        return chunk
+
+    def read(self,n=-1):
+        parts = [self._buf[self._pos:]]
+        have  = len(parts[0])
+        while n < 0 or have < n:
+            chunk = self._nextChunk()
+            if not chunk:
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        data = ''.join(parts)
+        if n < 0 or len(data) <= n:
+            self._buf, self._pos = '', 0
+            return data
+        self._buf, self._pos = data, n
+        return data[:n]
+
+    def readline(self):
+        nl = self._buf.find('\n', self._pos)
+        while nl == -1:
+            chunk = self._nextChunk()
+            if not chunk:
+                line = self._buf[self._pos:]
+                self._buf, self._pos = '', 0
+                return line
+            searchFrom = len(self._buf) - self._pos
+            self._buf, self._pos = self._buf[self._pos:] + chunk, 0
+            nl = self._buf.find('\n', searchFrom)
+        line = self._buf[self._pos:nl+1]
+        self._pos = nl + 1
+        return line
+
+    def readlines(self,sizehint=-1):
+        """Returns list of lines totalling about <sizehint> chars (all if < 0)."""
+        lines = []
+        total = 0
+        while sizehint < 0 or total < sizehint:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._stop = True
+        # -- unblock the producer if it is waiting on a full queue --
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        if self._rawFile:
+            self._rawFile.close()
+
+
+class _PrefixedFile(object):
+    """Read-only file returning <head> before the rest of <rawFile>: puts
+    sniffed magic bytes back in front of a stream that can not seek."""
+    def __init__(self,head,rawFile):
+        self._head = head
+        self._rawFile = rawFile
+        self.name = getattr(rawFile,'name',None)
+
+    def read(self,n=-1):
+        if not self._head:
+            return self._rawFile.read(n)
+        if n < 0:
+            data, self._head = self._head + self._rawFile.read(), ''
+        elif n <= len(self._head):
+            data, self._head = self._head[:n], self._head[n:]
+        else:
+            data, self._head = self._head + self._rawFile.read(n - len(self._head)), ''
+        return data
+
+    def tell(self):
+        return self._rawFile.tell() - len(self._head)
+
+    def close(self):
+        self._rawFile.close()
+
+
+def openInput(filePath,mode='rU',threads=None,maxChunks=8,readSize=1024*1024):
+    """Returns a readable file object for <filePath>, transparently
+    decompressing gzip, bgzip and bz2 files (detected from magic bytes, not
+    the extension) in a background thread.  BGZF blocks are inflated by a
+    pool of <threads> threads.
+    The path is opened once and sniffed on that handle, so FIFOs, /dev/stdin
+    and process substitutions work too: regular files seek back after the
+    sniff (uncompressed ones come back as a plain file object in <mode>),
+    streams get the sniffed bytes put back in front."""
+    rawFile = open(filePath, 'rb')
+    head = rawFile.read(18)
+    kind = _sniffHead(head)
+    if stat.S_ISREG(os.fstat(rawFile.fileno()).st_mode):
+        rawFile.seek(0)
+        if kind is None:
+            if mode == 'rb':
+                return rawFile
+            # -- same open file, reread in the requested (eg. universal newline) mode --
+            textFile = os.fdopen(os.dup(rawFile.fileno()), mode)
+            rawFile.close()
+            return textFile
+    else:
+        rawFile = _PrefixedFile(head,rawFile)
+        if kind is None:
+            chunks = iter(lambda: rawFile.read(readSize), '')
+            return BackgroundReader(chunks, maxChunks, universal='U' in mode, rawFile=rawFile)
+    if kind == 'bgzf':
+        chunks = iterBgzfChunks(rawFile, threads)
+    elif kind == 'gzip':
+        chunks = iterGzipChunks(rawFile, readSize)
+    else:
+        chunks = iterBz2Chunks(rawFile, readSize)
+    return BackgroundReader(chunks, maxChunks, universal='U' in mode, rawFile=rawFile)
@@ -0,0 +1,152 @@
+import numpy as np
+
+from scipherSrc.defs.files_io import ParseFastQ
+
+def guessPhredOffset(records):
+    """Returns 33 or 64 from the lowest quality char seen in <records>."""
+    lowest = min([min(rec[3]) for rec in records if rec[3]] or ['J'])
+    if ord(lowest) < 59:
+        return 33
+    return 64
+
+def _padMatrix(strs,fill=0):
+    """Returns (matrix,lengths): uint8 n x maxLen matrix holding the bytes of
+    each str in <strs> left-aligned, padded with <fill>."""
+    lengths = np.fromiter((len(x) for x in strs), dtype=np.int64, count=len(strs))
+    maxLen = int(lengths.max()) if len(strs) else 0
+    mat = np.empty((len(strs),maxLen), dtype=np.uint8)
+    mat.fill(fill)
+    mask = np.arange(maxLen)[None,:] < lengths[:,None]
+    mat[mask] = np.frombuffer(''.join(strs), dtype=np.uint8)
+    return mat,lengths
+
+def qualMatrix(records,offset=33):
+    """Decodes the quality strings of a batch of fastQ record tuples.
+    Returns (quals,lengths): uint8 n x maxLen Phred scores (0 past each
+    read's end) and int read lengths."""
+    mat,lengths = _padMatrix([rec[3] for rec in records],fill=offset)
+    mat -= offset
+    return mat,lengths
+
+def seqMatrix(records):
+    """Returns (seqs,lengths): uint8 n x maxLen ascii matrix of the read seqs."""
+    return _padMatrix([rec[1] for rec in records],fill=ord('N'))
+
+def meanQuality(quals,lengths):
+    """Returns float mean Phred score of each read."""
+    sums = quals.sum(axis=1, dtype=np.int64)
+    return sums / np.maximum(lengths,1).astype(np.float64)
+
+def nFraction(seqs,lengths):
+    """Returns float fraction of N/n bases in each read."""
+    isN = (seqs == ord('N')) | (seqs == ord('n'))
+    isN &= np.arange(seqs.shape[1])[None,:] < lengths[:,None]
+    return isN.sum(axis=1) / np.maximum(lengths,1).astype(np.float64)
+
+def slidingWindowTrim(quals,lengths,winSize=4,minQual=20):
+    """Returns new read lengths after 3' trimming: each read is cut at the
+    start of the first <winSize> window whose mean quality is < <minQual>.
+    Reads shorter than one window are kept whole if their mean passes,
+    else trimmed to 0."""
+    n,maxLen = quals.shape
+    if maxLen < winSize:
+        keep = meanQuality(quals,lengths) >= minQual
+        return np.where(keep, lengths, 0)
+    cs = np.zeros((n,maxLen+1), dtype=np.int64)
+    np.cumsum(quals, axis=1, out=cs[:,1:])
+    winSums = cs[:,winSize:] - cs[:,:-winSize]             # n x (maxLen-winSize+1)
+    pos = np.arange(winSums.shape[1])[None,:]
+    bad = (winSums < minQual*winSize) & (pos + winSize <= lengths[:,None])
+    anyBad = bad.any(axis=1)
+    newLengths = np.where(anyBad, bad.argmax(axis=1), lengths)
+    short = lengths < winSize
+    if short.any():
+        shortOk = meanQuality(quals[short],lengths[short]) >= minQual
+        newLengths[short] = np.where(shortOk, lengths[short], 0)
+    return newLengths
+
+def filterBatch(records,offset=33,minMeanQual=None,winSize=None,winQual=20,maxNFrac=None,minLength=1):
+    """Applies the chosen filters to a batch of fastQ record tuples at once
+    and returns (survivors,stats).  Steps, each optional:
+      sliding window 3' trim (<winSize>,<winQual>), then drop reads whose
+      mean quality < <minMeanQual>, N fraction > <maxNFrac> or trimmed
+      length < <minLength>.
+    stats is a dict of counts for the batch."""
+    if not records:
+        return [],{'reads':0,'kept':0,'trimmedBases':0}
+    quals,lengths = qualMatrix(records,offset)
+    newLengths = lengths
+    if winSize:
+        newLengths = slidingWindowTrim(quals,lengths,winSize,winQual)
+        # -- later filters only see the kept part of each read --
+        quals = np.where(np.arange(quals.shape[1])[None,:] < newLengths[:,None], quals, 0).astype(np.uint8)
+    keep = newLengths >= minLength
+    if minMeanQual is not None:
+        keep &= meanQuality(quals,newLengths) >= minMeanQual
+    if maxNFrac is not None:
+        seqs,seqLens = seqMatrix(records)
+        keep &= nFraction(seqs,newLengths) <= maxNFrac
+
+    survivors = []
+    for i in np.flatnonzero(keep):
+        rec = records[i]
+        L = newLengths[i]
+        if L != lengths[i]:
+            rec = (rec[0],rec[1][:L],rec[2],rec[3][:L])
+        survivors.append(rec)
+    stats = {'reads':len(records),
+             'kept':len(survivors),
+             'trimmedBases':int((lengths - newLengths)[keep].sum())}
+    return survivors,stats
+
+
+class FastQWriter(object):
+    """Writes fastQ record tuples, buffering about <bufferSize> chars per write."""
+    def __init__(self,outFile,bufferSize=4*1024*1024):
+        """<outFile> is a path or an open file."""
+        if isinstance(outFile,str):
+            outFile = open(outFile, 'w')
+        self._file = outFile
+        self._bufferSize = bufferSize
+        self._parts = []
+        self._size = 0
+
+    def writeBatch(self,records):
+        text = ''.join(['%s\n%s\n%s\n%s\n' % tuple(rec) for rec in records])
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self._bufferSize:
+            self.flush()
+
+    def write(self,rec):
+        self.writeBatch([rec])
+
+    def flush(self):
+        if self._parts:
+            self._file.write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def fastqQC(inPath,outPath,offset=None,batchSize=20000,**filterOpts):
+    """Streams <inPath> through filterBatch in batches of <batchSize> reads
+    and writes survivors to <outPath>.  <offset> (33 or 64) is guessed from
+    the first batch if None.  <filterOpts> are passed to filterBatch.
+    Returns dict of total counts."""
+    parser = ParseFastQ(inPath)
+    writer = FastQWriter(outPath)
+    totals = {'reads':0,'kept':0,'trimmedBases':0}
+    for batch in parser.iterBatches(batchSize):
+        if offset is None:
+            offset = guessPhredOffset(batch)
+        survivors,stats = filterBatch(batch,offset,**filterOpts)
+        writer.writeBatch(survivors)
+        for k in totals:
+            totals[k] += stats[k]
+    writer.close()
+    parser.close()
+    return totals
@@ -0,0 +1,195 @@
+import os
+import shutil
+import tempfile
+
+from scipherSrc.defs.files_io import ParseFastQ,ParseFastA
+from scipherSrc.defs.compressedIO import sniffCompression
+
+class RangeFile(object):
+    """Read-only file-like view of bytes [start,end) of a file."""
+    def __init__(self,filePath,start,end):
+        self._file = open(filePath, 'rb')
+        self._file.seek(start)
+        self._pos = start
+        self._end = end
+
+    def read(self,n=-1):
+        left = self._end - self._pos
+        if n < 0 or n > left:
+            n = left
+        data = self._file.read(n)
+        self._pos += len(data)
+        return data
+
+    def readline(self):
+        if self._pos >= self._end:
+            return ''
+        line = self._file.readline(self._end - self._pos)
+        self._pos += len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline,'')
+
+    def close(self):
+        self._file.close()
+
+
+def _isFastQStart(lines):
+    """True if <lines> (at least 4, more is better) start with a whole fastQ record."""
+    if len(lines) < 4:
+        return False
+    head,seq,plus,qual = [x.rstrip('\r\n') for x in lines[:4]]
+    if not (head.startswith('@') and plus.startswith('+') and len(seq) == len(qual)):
+        return False
+    # -- a '@' qual line followed by a seq line can not also satisfy the next record --
+    if len(lines) > 4 and lines[4].strip() and not lines[4].startswith('@'):
+        return False
+    return True
+
+def _nextRecordStart(f,offset,fmt):
+    """Returns offset of the first record that starts at or after <offset>."""
+    if offset == 0:
+        return 0
+    f.seek(offset - 1)
+    if f.read(1) != '\n':
+        f.readline()   # -- skip the partial line --
+    pos = f.tell()
+    lines = []
+    lineStarts = []
+    while 1:
+        if fmt == 'fasta':
+            line = f.readline()
+            if not line or line.startswith('>'):
+                return pos
+            pos += len(line)
+            continue
+        # -- fastq: look at a sliding block of 8 lines to resolve '@' quality lines --
+        while len(lines) < 8:
+            line = f.readline()
+            if not line:
+                break
+            lineStarts.append(pos + sum([len(x) for x in lines]))
+            lines.append(line)
+        if len(lines) < 4:
+            return f.tell()
+        if _isFastQStart(lines):
+            return lineStarts[0]
+        lines.pop(0)
+        lineStarts.pop(0)
+
+def chunkBounds(filePath,nChunks,fmt='fastq'):
+    """Splits <filePath> into up to <nChunks> byte ranges [(start,end),...]
+    that each begin on a record start, so every range can be parsed on its
+    own.  For fastq, '@'/'+' at the start of quality lines are told apart
+    from headers by checking the 4-line record layout."""
+    if sniffCompression(filePath):
+        raise Exception("**ERROR** compressed files can not be split into byte ranges: %s" % (filePath))
+    size = os.path.getsize(filePath)
+    f = open(filePath, 'rb')
+    starts = sorted(set([_nextRecordStart(f,(size*i)//nChunks,fmt) for i in range(nChunks)]))
+    f.close()
+    starts = [x for x in starts if x < size] or [0]
+    return zip(starts,starts[1:] + [size])
+
+def openChunkParser(filePath,start,end,fmt='fastq'):
+    """Returns a ParseFastQ/ParseFastA reading only bytes [start,end)."""
+    rangeFile = RangeFile(filePath,start,end)
+    if fmt == 'fastq':
+        return ParseFastQ(rangeFile)
+    return ParseFastA(rangeFile)
+
+
+# ++++ map/reduce over chunks ++++
+
+def _runChunk(args):
+    filePath,fmt,start,end,func,funcArgs = args
+    parser = openChunkParser(filePath,start,end,fmt)
+    return func(parser,*funcArgs)
+
+def mapChunks(filePath,func,funcArgs=(),fmt='fastq',processes=None):
+    """Calls <func>(parser,*funcArgs) on one parser per chunk of <filePath>
+    in a pool of <processes> workers (func must be a module-level func).
+    Returns the list of results in file order."""
+    import multiprocessing
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    bounds = chunkBounds(filePath,processes,fmt)
+    jobs = [(filePath,fmt,start,end,func,funcArgs) for start,end in bounds]
+    if processes == 1 or len(jobs) == 1:
+        return map(_runChunk,jobs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_runChunk,jobs)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def _countChunk(parser,fmt):
+    recs = bases = 0
+    for rec in parser:
+        if rec:
+            recs  += 1
+            bases += len(rec[1])
+    return recs,bases
+
+def countRecords(filePath,fmt='fastq',processes=None):
+    """Returns (records,bases) of <filePath> counted in parallel."""
+    results = mapChunks(filePath,_countChunk,(fmt,),fmt,processes)
+    return sum([r[0] for r in results]),sum([r[1] for r in results])
+
+def _kmerChunk(parser,k,alphabet):
+    from scipherSrc.defs.markovModels import MkvCounts
+    counts = MkvCounts(k-1,alphabet)
+    for rec in parser:
+        if rec:
+            counts.addSeq(rec[1])
+    return counts.counts
+
+def tallyKmers(filePath,k,fmt='fastq',alphabet='ACGT',processes=None):
+    """Returns markovModels.MkvCounts of all <k>-mers in the seqs of
+    <filePath> (ie. an order k-1 background), tallied in parallel."""
+    from scipherSrc.defs.markovModels import MkvCounts
+    total = MkvCounts(k-1,alphabet)
+    for counts in mapChunks(filePath,_kmerChunk,(k,alphabet),fmt,processes):
+        total += MkvCounts(k-1,alphabet,counts)
+    return total
+
+def _filterChunk(parser,keepFunc,fmt,tmpDir):
+    part = tempfile.NamedTemporaryFile(dir=tmpDir, delete=False)
+    kept = 0
+    buf = []
+    for rec in parser:
+        if rec and keepFunc(rec):
+            if fmt == 'fastq':
+                buf.append('%s\n%s\n%s\n%s\n' % tuple(rec))
+            else:
+                buf.append('>%s\n%s\n' % tuple(rec))
+            kept += 1
+            if len(buf) >= 10000:
+                part.write(''.join(buf))
+                buf = []
+    part.write(''.join(buf))
+    part.close()
+    return part.name,kept
+
+def filterRecords(filePath,outPath,keepFunc,fmt='fastq',processes=None,tmpDir=None):
+    """Writes the records of <filePath> for which <keepFunc>(rec) is True
+    to <outPath>, keeping file order (<keepFunc> must be a module-level
+    func so it can be pickled).  Chunks are filtered in parallel into
+    temp part files that are then concatenated.  Returns number kept.
+    (fastA records are written back with their parsed name on one line.)"""
+    results = mapChunks(filePath,_filterChunk,(keepFunc,fmt,tmpDir),fmt,processes)
+    outFile = open(outPath, 'wb')
+    try:
+        for partName,kept in results:
+            part = open(partName, 'rb')
+            shutil.copyfileobj(part,outFile,16*1024*1024)
+            part.close()
+    finally:
+        outFile.close()
+        for partName,kept in results:
+            os.remove(partName)
+    return sum([r[1] for r in results])
@@ -1,6 +1,13 @@
+import os
+import array
+import heapq
+import itertools
+import tempfile
 import collections
 import csv
 
+from scipherSrc.defs.compressedIO import openInput
+
 def xls2csv(xlsPath,csvPath=None,sep=','):
     """
     Does what it says.
@@ -21,21 +28,138 @@ def xls2csv(xlsPath,csvPath=None,sep=','):
     if csvPath != None:
         csvFile.close()
 
-def tableFile2namedTuple(tablePath,sep='\t'):
-    """Returns namedTuple from table file using first row fields as col headers."""
+def _tableRowMaker(headers,types=None):
+    """Returns func turning a list of fields into a 'Table' namedTuple,
+    converting the columns named in <types> ({colName:func}) on the way."""
+    Table   = collections.namedtuple('Table', ', '.join(headers))
+    if not types:
+        return Table._make
+    converters = [(headers.index(col),func) for col,func in types.items()]
+    def makeRow(row):
+        for i,func in converters:
+            row[i] = func(row[i])
+        return Table._make(row)
+    return makeRow
+
+def tableFile2namedTuple(tablePath,sep='\t',lazy=False,types=None,headers=None):
+    """Returns namedTuple from table file using first row fields as col headers.
+    <tablePath> may also be an open file or any iterable of lines.
+    <lazy>: if True, returns a generator that yields the rows one at a time
+    instead of a list of every row.
+    <types>: dict {colName:func} used to convert those columns once as rows
+    are read. Exmpl: types={'seq_region_start':int,'seq_region_end':int}
+    <headers>: col headers to use for a table with no header row (eg. the
+    lines of a fileChunks.RangeFile over part of a table)."""
 
-    reader  = csv.reader(open(tablePath), delimiter=sep)
+    if not isinstance(tablePath,basestring):
+        tableFile = tablePath
+    else:
+        tableFile = openInput(tablePath)
+    reader  = csv.reader(tableFile, delimiter=sep)
+    if headers is None:
+        headers = reader.next()
+    makeRow = _tableRowMaker(headers,types)
+    if lazy:
+        return itertools.imap(makeRow, reader)
+    data    = map(makeRow, reader)
+    return data
+
+def tableFile2columns(tablePath,columns=None,sep='\t',types=None,asNumpy=False,chunkSize=100000):
+    """Returns dict {colName:column} from table file using first row fields as col headers.
+    Only <columns> (default: all) are kept.
+    <types>: dict {colName:typecode} (array module codes, eg. 'l' or 'd'):
+    those columns are parsed once into compact array.array objects; the rest
+    are lists of str.
+    <asNumpy>: typed columns are returned as numpy arrays (sharing the array memory).
+    Rows are read in chunks of <chunkSize> so memory holds only the kept columns."""
+    reader  = csv.reader(openInput(tablePath), delimiter=sep)
     headers = reader.next()
-    Table   = collections.namedtuple('Table', ', '.join(headers))
-    data    = map(Table._make, reader)
+    if columns is None:
+        columns = headers
+    if not types:
+        types = {}
+    for col in list(columns) + list(types):
+        if col not in headers:
+            raise Exception("**ERROR** %s is not a column in %s." % (col,tablePath))
+    
+    data = {}
+    converters = []
+    for col in columns:
+        code = types.get(col)
+        if code:
+            data[col] = array.array(code)
+            func = float if code in 'fd' else int
+        else:
+            data[col] = []
+            func = None
+        converters.append((headers.index(col),col,func))
+    
+    while 1:
+        rows = list(itertools.islice(reader,chunkSize))
+        if not rows:
+            break
+        for i,col,func in converters:
+            vals = [row[i] for row in rows]
+            if func:
+                vals = map(func,vals)
+            data[col].extend(vals)
+    
+    if asNumpy:
+        import numpy as np
+        for col,code in types.items():
+            if col in data:
+                data[col] = np.frombuffer(data[col], dtype=np.dtype(code)) if len(data[col]) else np.array([], dtype=np.dtype(code))
     return data
 
+def _decoratedRun(runFile,runNum,sep,rowKey):
+    """Yields (key,runNum,rowNum,row) for rows of one sorted temp run."""
+    for rowNum,row in enumerate(csv.reader(runFile, delimiter=sep)):
+        yield (rowKey(row),runNum,rowNum,row)
+
+def externalSortTable(tablePath,keyCols,sep='\t',types=None,chunkRows=1000000,tmpDir=None):
+    """Yields namedTuple rows of a table file (first row == col headers)
+    in order of the columns named in <keyCols> (compared as strings).
+    Runs of <chunkRows> rows are sorted in memory and spilled to temp files
+    in <tmpDir>, then merged lazily, so files larger than RAM can be sorted.
+    <types> is as in tableFile2namedTuple."""
+    reader  = csv.reader(openInput(tablePath), delimiter=sep)
+    headers = reader.next()
+    makeRow = _tableRowMaker(headers,types)
+    keyIdx  = [headers.index(col) for col in keyCols]
+    def rowKey(row):
+        return tuple([row[i] for i in keyIdx])
+    
+    runs = []
+    try:
+        while 1:
+            rows = list(itertools.islice(reader,chunkRows))
+            if not rows:
+                break
+            rows.sort(key=rowKey)
+            if not runs and len(rows) < chunkRows:
+                # -- whole table fit in one run: no need to touch the disk --
+                for row in rows:
+                    yield makeRow(row)
+                return
+            runFile = tempfile.TemporaryFile(dir=tmpDir)
+            csv.writer(runFile, delimiter=sep, lineterminator='\n').writerows(rows)
+            runFile.seek(0)
+            runs.append(runFile)
+            del rows
+        
+        merged = heapq.merge(*[_decoratedRun(runFile,n,sep,rowKey) for n,runFile in enumerate(runs)])
+        for item in merged:
+            yield makeRow(item[3])
+    finally:
+        for runFile in runs:
+            runFile.close()
+
 class ParseSolexaSorted(object):
     """Class to parse and return a single read entry from solexa x_sorted.txt file type."""
     def __init__(self,filePath):
         """Returns a line-by-line solexa x_sorted.txt parser analogous to file.readline().
         Exmpl: parser.getNext() """
-        self._file = open(filePath, 'rU')
+        self._file = openInput(filePath)
     
     def _parseCoords(self,line):
         """Takes solexa file line, returns t(contig,start,stop)"""
@@ -70,7 +194,7 @@ class ParseBowtieMap(object):
     def __init__(self,filePath):
         """Returns a line-by-line bowtie.map parser analogous to file.readline().
         Exmpl: parser.getNext() """
-        self._file = open(filePath, 'rU')
+        self._file = openInput(filePath)
         
     def _parseCoords(self,line):
         """Returns coords info t(contig,start,stop) for a bowtie.map line tuple"""
@@ -98,9 +222,244 @@ class ParseBowtieMap(object):
             return self._parseReadSeq(line)
 
 
+def _defaultFastaKey(headerLine):
+    """Returns first whitespace-delimited word of a fastA header line (minus '>')."""
+    return headerLine[1:].split()[0]
+
+
+class FastQBlockReader(object):
+    """Block-buffered engine behind ParseFastQ.
+    Reads the file in large blocks (or mmaps it whole).  Each block is split
+    into lines with one str.split() and the lines are grouped four at a
+    time into records; the unfinished last record is carried over to the
+    next block.  With <views>, line boundaries are located with str.find()
+    on the buffer instead, so fields can point into it."""
+    def __init__(self,fileObj,headerSymbols=['@','+'],blockSize=4*1024*1024,useMmap=False,views=False):
+        """<fileObj> is an open file (or any object with a read(n) method).
+        <blockSize> is the number of bytes pulled per read.
+        <useMmap> maps the whole file at once instead of reading blocks
+        (fileObj must then be a real file on disk).
+        <views> if True, record fields are returned as memoryviews into the
+        buffer instead of new strings."""
+        self._file  = fileObj
+        self._hdSyms = headerSymbols
+        self._blockSize = blockSize
+        self._views = views
+        self._linesDone = 0   # -- lines before the current block's records --
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._mmap = None
+        # -- split mode: parsed records of the current block, next one at _recIdx --
+        self._source = fileObj
+        self._carry  = ''
+        self._recs   = []
+        self._recIdx = 0
+        self._error  = None
+        if useMmap:
+            import mmap
+            if os.fstat(fileObj.fileno()).st_size > 0:
+                self._mmap = mmap.mmap(fileObj.fileno(), 0, access=mmap.ACCESS_READ)
+                self._buf  = self._mmap
+                self._source = self._mmap
+            else:
+                self._source = None
+            self._eof = views
+        self._view = None
+        if views and self._mmap:
+            try:
+                self._view = memoryview(self._mmap)
+            except TypeError:
+                pass # py2 mmap only exposes the old buffer interface: use buffer() slices
+    
+    @property
+    def _currentLineNumber(self):
+        return self._linesDone + 4*self._recIdx
+    
+    # ++++ split mode (views=False) ++++
+    
+    def _recordError(self,rec):
+        """Returns the error message for malformed record <rec> (list of its
+        lines), or None if it is fine."""
+        if len(rec) != 4 or '' in rec:
+            return "** ERROR: It looks like I encountered a premature EOF or empty line.\n\
+               Please check FastQ file near line #%s (plus or minus ~4 lines) and try again**"
+        if not rec[0].startswith(self._hdSyms[0]):
+            return "** ERROR: The 1st line in fastq element does not start with '%s'.\n\
+               Please check FastQ file and try again **" % (self._hdSyms[0])
+        if not rec[2].startswith(self._hdSyms[1]):
+            return "** ERROR: The 3rd line in fastq element does not start with '%s'.\n\
+               Please check FastQ file and try again **" % (self._hdSyms[1])
+        return None
+    
+    def _splitRecords(self,lines):
+        """Groups whole <lines> into record tuples, stopping before the first
+        malformed record (its error is kept for when it is reached)."""
+        it = iter(lines)
+        recs = zip(it,it,it,it)
+        hd,qd = self._hdSyms
+        # -- joined prefixes equal hd*n only if every prefix is exactly hd --
+        if '' in lines or \
+           ''.join([x[:len(hd)] for x in lines[0::4]]) != hd*len(recs) or \
+           ''.join([x[:len(qd)] for x in lines[2::4]]) != qd*len(recs):
+            for i,rec in enumerate(recs):
+                error = self._recordError(list(rec))
+                if error:
+                    self._error = error
+                    return recs[:i]
+        return recs
+    
+    def _readRecords(self):
+        """Parses the next block into self._recs.  Returns False once no
+        records are left."""
+        while not self._eof:
+            data = self._source.read(self._blockSize) if self._source is not None else ''
+            if not data:
+                self._eof = True
+                break
+            lines = (self._carry + data).split('\n')
+            nWhole = ((len(lines) - 1) // 4) * 4
+            self._carry = '\n'.join(lines[nWhole:])
+            del lines[nWhole:]
+            if not lines:
+                continue
+            if '\r' in data:
+                lines = [x[:-1] if x.endswith('\r') else x for x in lines]
+            self._linesDone += 4*len(self._recs)
+            self._recs,self._recIdx = self._splitRecords(lines),0
+            return True
+        # -- what is left: nothing, or a last record without a trailing newline --
+        tail,self._carry = self._carry,''
+        if tail:
+            lines = tail.split('\n')
+            if lines[-1] == '':
+                lines.pop()
+            lines = [x[:-1] if x.endswith('\r') else x for x in lines]
+            self._error = self._recordError(lines)
+            self._linesDone += 4*len(self._recs)
+            self._recs,self._recIdx = ([] if self._error else [tuple(lines)]),0
+            return True
+        return False
+    
+    # ++++ views mode ++++
+    
+    def _fill(self):
+        """Appends the next block to the unconsumed tail of the buffer.
+        Returns False once the file is exhausted."""
+        if self._eof:
+            return False
+        data = self._file.read(self._blockSize)
+        if not data:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        self._view = memoryview(self._buf)
+        return True
+    
+    def _nextLines(self):
+        """Returns list of (start,end) offsets for up to four lines."""
+        spans = []
+        pos = self._pos
+        while len(spans) < 4:
+            nl = self._buf.find('\n', pos)
+            if nl == -1:
+                # -- line is split across blocks: pull more data and rescan --
+                offset = self._pos
+                if self._fill():
+                    pos   -= offset
+                    spans  = [(a-offset,b-offset) for a,b in spans]
+                    continue
+                # -- final line without a trailing newline --
+                if pos < len(self._buf):
+                    spans.append((pos,len(self._buf)))
+                    pos = len(self._buf)
+                break
+            end = nl
+            if end > pos and self._buf[end-1] == '\r':
+                end -= 1
+            spans.append((pos,end))
+            pos = nl + 1
+        self._pos = pos
+        return spans
+    
+    def _nextView(self):
+        spans = self._nextLines()
+        if not spans:
+            raise StopIteration
+        # -- line prefixes are enough to check the record --
+        L = max([len(x) for x in self._hdSyms] + [1])
+        error = self._recordError([self._buf[a:min(b,a+L)] for a,b in spans])
+        if error:
+            self._error = error
+            self._raiseError()
+        self._linesDone += 4
+        if self._view is None:
+            return tuple([buffer(self._buf,a,b-a) for a,b in spans])
+        return tuple([self._view[a:b] for a,b in spans])
+    
+    # ++++ public ++++
+    
+    def __iter__(self):
+        return self
+    
+    def _raiseError(self):
+        error,self._error = self._error,None
+        raise AssertionError(error.replace('#%s','#%s' % (self._currentLineNumber + 1)))
+    
+    def next(self):
+        """Reads in next element, parses, and does minimal verification.
+        Returns: tuple: (seqHeader,seqStr,qualHeader,qualStr)"""
+        if self._views:
+            return self._nextView()
+        try:
+            rec = self._recs[self._recIdx]
+            self._recIdx += 1
+            return rec
+        except IndexError:
+            pass
+        if self._error:
+            self._raiseError()
+        if not self._readRecords():
+            raise StopIteration
+        return self.next()
+    
+    def nextBatch(self,n):
+        """Returns list of up to <n> records; empty list at EOF."""
+        batch = []
+        if not self._views:
+            # -- whole slices of the parsed block --
+            while len(batch) < n:
+                if self._recIdx >= len(self._recs):
+                    try:
+                        batch.append(self.next())
+                    except StopIteration:
+                        break
+                    continue
+                take = self._recs[self._recIdx:self._recIdx + n - len(batch)]
+                self._recIdx += len(take)
+                batch.extend(take)
+            return batch
+        try:
+            for i in xrange(n):
+                batch.append(self.next())
+        except StopIteration:
+            pass
+        return batch
+    
+    def close(self):
+        if self._views:
+            self._view = None
+        if self._mmap:
+            self._buf = ''
+            self._source = None
+            self._mmap.close()
+        self._file.close()
+
+
 class ParseFastQ(object):
     """Returns a read-by-read fastQ parser analogous to file.readline()"""
-    def __init__(self,filePath,headerSymbols=['@','+']):
+    def __init__(self,filePath,headerSymbols=['@','+'],blockSize=4*1024*1024,useMmap=False,views=False):
         """Returns a read-by-read fastQ parser analogous to file.readline().
         Exmpl: parser.next()
         -OR-
@@ -109,47 +468,50 @@ class ParseFastQ(object):
             ... do something with rec ...
 
         rec is tuple: (seqHeader,seqStr,qualHeader,qualStr)
+        
+        Records are pulled from a FastQBlockReader: see that class for
+        <blockSize>, <useMmap> and <views>.
+        gzip/bgzip/bz2 files are decompressed on the fly (see compressedIO.openInput).
+        Use parser.nextBatch(n) or parser.iterBatches(n) to get n records at once.
+        <filePath> may also be an already open file-like object.
         """
-        self._file = open(filePath, 'rU')
-        self._currentLineNumber = 0
+        if hasattr(filePath,'read'):
+            self._file = filePath
+            useMmap = useMmap and isinstance(self._file, file)
+        elif useMmap:
+            self._file = openInput(filePath, 'rb')
+            # -- compressed input can not be mapped: fall back to block reads --
+            useMmap = isinstance(self._file, file)
+        else:
+            self._file = openInput(filePath)
         self._hdSyms = headerSymbols
+        self._engine = FastQBlockReader(self._file,headerSymbols=headerSymbols,
+                                        blockSize=blockSize,useMmap=useMmap,views=views)
+    
+    @property
+    def _currentLineNumber(self):
+        return self._engine._currentLineNumber
         
     def __iter__(self):
-        return self
+        # -- the engine holds all state, so looping on it directly is the same stream --
+        return self._engine
     
     def next(self):
         """Reads in next element, parses, and does minimal verification.
         Returns: tuple: (seqHeader,seqStr,qualHeader,qualStr)"""
-        # ++++ Get Next Four Lines ++++
-        elemList = []
-        for i in range(4):
-            line = self._file.readline()
-            self._currentLineNumber += 1 ## increment file position
-            if line:
-                elemList.append(line.strip('\n'))
-            else: 
-                elemList.append(None)
-        
-        # ++++ Check Lines For Expected Form ++++
-        trues = [bool(x) for x in elemList].count(True)
-        nones = elemList.count(None)
-        # -- Check for acceptable end of file --
-        if nones == 4:
-            raise StopIteration
-        # -- Make sure we got 4 full lines of data --
-        assert trues == 4,\
-               "** ERROR: It looks like I encountered a premature EOF or empty line.\n\
-               Please check FastQ file near line #%s (plus or minus ~4 lines) and try again**" % (self._currentLineNumber)
-        # -- Make sure we are in the correct "register" --
-        assert elemList[0].startswith(self._hdSyms[0]),\
-               "** ERROR: The 1st line in fastq element does not start with '%s'.\n\
-               Please check FastQ file and try again **" % (self._hdSyms[0])
-        assert elemList[2].startswith(self._hdSyms[1]),\
-               "** ERROR: The 3rd line in fastq element does not start with '%s'.\n\
-               Please check FastQ file and try again **" % (self._hdSyms[1])
-        
-        # ++++ Return fatsQ data as tuple ++++
-        return tuple(elemList)
+        return self._engine.next()
+    
+    def nextBatch(self,n):
+        """Returns list of up to <n> record tuples; empty list at EOF."""
+        return self._engine.nextBatch(n)
+    
+    def iterBatches(self,n):
+        """Yields lists of <n> record tuples (the last may be shorter)."""
+        while 1:
+            batch = self._engine.nextBatch(n)
+            if not batch:
+                break
+            yield batch
     
     def getNextReadSeq(self):
         """Convenience method: calls self.getNext and returns only the readSeq."""
@@ -158,6 +520,9 @@ class ParseFastQ(object):
             return record[1]
         except StopIteration:
             return None
+    
+    def close(self):
+        self._engine.close()
 
             
 
@@ -173,15 +538,21 @@ class ParseFastA(object):
         joinWith='' results in a single line with no breaks (usually what you want!)
         
         <key> is func used to parse the recName from HeaderInfo.
+        
+        <filePath> may also be an already open file-like object.
         """
         
-        self._file = open(filePath, 'rU')
+        if hasattr(filePath,'readline'):
+            self._file = filePath
+        else:
+            self._file = openInput(filePath)
         if key:
             self._key = key
         else:
-            self._key = lambda x:x[1:].split()[0]
+            self._key = _defaultFastaKey
         self.bufferLine = None   # stores next headerLine between records.
         self.joinWith = joinWith
+        self._eof = False
         
     
     def __iter__(self):
@@ -191,6 +562,8 @@ class ParseFastA(object):
         """Reads in next element, parses, and does minimal verification.
         Returns: tuple: (seqName,seqStr)"""
         # ++++ Get A Record ++++
+        if self._eof:
+            raise StopIteration
         recHead = ''
         recData = []
         # ++++ Check to see if we already have a headerLine ++++
@@ -213,7 +586,11 @@ class ParseFastA(object):
         while 1:
             line = self._file.readline()
             if not line:
-                raise StopIteration
+                # -- last record in file: return it now, stop on the next call --
+                self._eof = True
+                if not recData:
+                    raise StopIteration
+                break
             elif line.startswith('>'):
                 self.bufferLine = line.strip('\n')
                 break
@@ -231,7 +608,8 @@ class ParseFastA(object):
     
     def toDict(self):
         """Returns a single Dict populated with the fastaRecs
-        contained in self._file."""
+        contained in self._file.
+        To look up a few records/regions of a big file, use IndexedFastA instead."""
         fasDict = {}
         while 1:
             try:
@@ -245,4 +623,146 @@ class ParseFastA(object):
                     raise Exception, "DuplicateFastaRec: %s occurs in your file more than once."
             else:
                 break
-        return fasDict
\ No newline at end of file
+        return fasDict
+    
+    def toPackedDict(self):
+        """As toDict, but each seq is stored as a 2-bit packedSeq.PackedSeq
+        (about 1/4 the memory of a str)."""
+        from scipherSrc.defs.packedSeq import PackedSeq
+        fasDict = {}
+        for fasRec in self:
+            if not fasRec:
+                break
+            if fasRec[0] in fasDict:
+                raise Exception, "DuplicateFastaRec: %s occurs in your file more than once." % (fasRec[0])
+            fasDict[fasRec[0]] = PackedSeq.fromStr(fasRec[1])
+        return fasDict
+
+
+def buildFastaIndex(fastaPath,faiPath=None,key=None):
+    """Makes one pass over <fastaPath> and writes a samtools-compatible
+    .fai sidecar (default: fastaPath+'.fai').
+    Each line: name, seqLength, byteOffset, lineBases, lineWidth.
+    <key> is func used to parse the recName from HeaderInfo (as in ParseFastA).
+    Returns the faiPath."""
+    if not faiPath:
+        faiPath = fastaPath + '.fai'
+    if not key:
+        key = _defaultFastaKey
+    
+    entries = []
+    names   = set()
+    rec     = None  # [name,seqLen,offset,lineBases,lineWidth,lastLineShort]
+    fasFile = open(fastaPath, 'rb')
+    pos     = 0
+    for line in fasFile:
+        lineLen = len(line)
+        if line.startswith('>'):
+            if rec:
+                entries.append(rec[:5])
+            name = key(line.rstrip('\r\n'))
+            if name in names:
+                raise Exception("DuplicateFastaRec: %s occurs in your file more than once." % (name))
+            names.add(name)
+            rec = [name,0,pos+lineLen,0,0,False]
+        elif rec is None:
+            if line.strip():
+                raise Exception('CheckFastaFile: The first line containing text does not start with ">".')
+        else:
+            bases = len(line.rstrip('\r\n'))
+            if bases:
+                # -- every line but the last of a record must have the same length --
+                if rec[5] or (rec[3] and (bases > rec[3] or \
+                              (bases == rec[3] and lineLen != rec[4] and line.endswith('\n')))):
+                    raise Exception("CheckFastaFile: Record %s has uneven line lengths; cannot be indexed." % (rec[0]))
+                if not rec[3]:
+                    rec[3] = bases
+                    rec[4] = lineLen
+                elif bases < rec[3]:
+                    rec[5] = True
+                rec[1] += bases
+            else:
+                rec[5] = True
+        pos += lineLen
+    fasFile.close()
+    if rec:
+        entries.append(rec[:5])
+    
+    faiFile = open(faiPath, 'w')
+    for e in entries:
+        faiFile.write('%s\n' % ('\t'.join([str(x) for x in e])))
+    faiFile.close()
+    return faiPath
+
+
+class IndexedFastA(object):
+    """Random access to fastA records through a .fai index and an mmapped file.
+    Only the index is held in memory; sequence is sliced from the map on demand."""
+    def __init__(self,filePath,faiPath=None,key=None,rebuild=False):
+        """Returns an indexed fastA reader.
+        Exmpl: fas.fetch('chr2L',1000,2000)
+        
+        <faiPath> defaults to filePath+'.fai'; it is built (see buildFastaIndex)
+        if missing, older than the fastA, or if <rebuild> is True.
+        <key> is func used to parse the recName from HeaderInfo (as in ParseFastA).
+        """
+        if not faiPath:
+            faiPath = filePath + '.fai'
+        if rebuild or not os.path.exists(faiPath) or \
+           os.path.getmtime(faiPath) < os.path.getmtime(filePath):
+            buildFastaIndex(filePath,faiPath,key=key)
+        
+        self._index = collections.OrderedDict()
+        for line in open(faiPath):
+            fields = line.rstrip('\n').split('\t')
+            self._index[fields[0]] = tuple([int(x) for x in fields[1:5]])
+        
+        import mmap
+        self._file = open(filePath, 'rb')
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = ''
+    
+    def __contains__(self,name):
+        return name in self._index
+    
+    def __len__(self):
+        return len(self._index)
+    
+    def __iter__(self):
+        return iter(self._index)
+    
+    def keys(self):
+        return self._index.keys()
+    
+    def seqLength(self,name):
+        """Returns length of record <name>."""
+        return self._index[name][0]
+    
+    def fetch(self,name,start=None,end=None):
+        """Returns seqStr for record <name> between <start> and <end>.
+        Coords are 0-based and end-exclusive, like python slices; None means
+        the start/end of the record.  Cost depends only on the region size."""
+        try:
+            seqLen,offset,lineBases,lineWidth = self._index[name]
+        except KeyError:
+            raise KeyError("%s is not in the fastA index." % (name))
+        start,end,step = slice(start,end).indices(seqLen)
+        if start >= end:
+            return ''
+        
+        def byteOf(i):
+            return offset + (i // lineBases)*lineWidth + (i % lineBases)
+        chunk = self._mmap[byteOf(start):byteOf(end-1)+1]
+        if lineWidth - lineBases == 1:
+            return chunk.replace('\n','')
+        return chunk.replace('\r','').replace('\n','')
+    
+    def __getitem__(self,name):
+        return self.fetch(name)
+    
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        self._file.close()
@@ -0,0 +1,247 @@
+import os
+import sys
+import stat
+import time
+import resource
+
+from scipherSrc.defs.pipeline import StageStats,iterParser
+
+def readBytes():
+    """Returns bytes read by this process so far (/proc/self/io rchar), or
+    None where that is not available."""
+    try:
+        for line in open('/proc/self/io'):
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def peakRssMB():
+    # -- ru_maxrss is KB on linux, bytes on OS X --
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+def _sourceFile(source):
+    """Returns the on-disk file object behind a files_io parser (the raw
+    compressed file for compressedIO readers), or None."""
+    f = getattr(source,'_file',None)
+    f = getattr(f,'_rawFile',None) or f
+    try:
+        if hasattr(f,'tell') and stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+            return f
+    except (AttributeError,IOError,OSError,ValueError):
+        pass
+    return None
+
+
+class ProgressReporter(object):
+    """Prints a throughput line to <stream> at most every <interval> seconds.
+    update() only looks at the clock every <checkEvery> records, so calling
+    it once per record is cheap."""
+    def __init__(self,name,stream=sys.stderr,interval=5.0,totalBytes=None,checkEvery=1000):
+        self.name = name
+        self.stream = stream
+        self.interval = interval
+        self.totalBytes = totalBytes
+        self.checkEvery = checkEvery
+        self.started = time.time()
+        self._nextCheck = checkEvery
+        self._lastReport = self.started
+
+    def update(self,records,nBytes=None):
+        if records < self._nextCheck:
+            return
+        self._nextCheck = records + self.checkEvery
+        now = time.time()
+        if now - self._lastReport >= self.interval:
+            self._lastReport = now
+            self.report(records,nBytes,now)
+
+    def report(self,records,nBytes=None,now=None,final=False):
+        elapsed = max((now or time.time()) - self.started,1e-9)
+        line = '[%s] %s recs %.1fs %.0f recs/s' % (self.name,records,elapsed,records/elapsed)
+        if nBytes is not None:
+            line += ' %.1f MB %.2f MB/s' % (nBytes/1048576.0,nBytes/1048576.0/elapsed)
+            if self.totalBytes and not final:
+                line += ' (%.1f%%)' % (100.0*nBytes/self.totalBytes)
+        if final:
+            line += ' done'
+        print >> self.stream, line
+        self.stream.flush()
+
+
+class Instrumented(object):
+    """Iterator wrapping a files_io parser (or any iterable of records) that
+    counts records and bytes read, times the time spent pulling records
+    (StageStats.busy, which includes any upstream iterators) and feeds a
+    ProgressReporter.  Nothing is wrapped unless asked for, so code paths
+    without instrumentation pay nothing.
+    Exmpl:
+        for rec in Instrumented(ParseFastQ('reads.fq.gz'),'reads',progress=True):
+            ..."""
+    def __init__(self,source,name=None,progress=False,interval=5.0,stream=sys.stderr,timeStages=True):
+        """<progress>: print throughput every <interval> seconds to <stream>.
+        <timeStages>: time each pull (two clock reads per record)."""
+        self.source = source
+        self.stats = StageStats(name or source.__class__.__name__)
+        self.stats.bytes = 0
+        self._records = iterParser(source)
+        self._file = _sourceFile(source)
+        self._startBytes = self._file.tell() if self._file else readBytes()
+        totalBytes = os.fstat(self._file.fileno()).st_size if self._file else None
+        self._progress = None
+        if progress:
+            self._progress = ProgressReporter(self.stats.name,stream,interval,totalBytes)
+        self._timeStages = timeStages
+
+    def bytesRead(self):
+        try:
+            if self._file:
+                return self._file.tell() - self._startBytes
+        except (IOError,ValueError):
+            return None
+        if self._startBytes is not None:
+            return readBytes() - self._startBytes
+        return None
+
+    def __iter__(self):
+        stats = self.stats
+        stats.started = time.time()
+        records = self._records
+        progress = self._progress
+        clock = time.time
+        n = 0
+        try:
+            if self._timeStages:
+                while 1:
+                    t = clock()
+                    try:
+                        rec = records.next()
+                    except StopIteration:
+                        break
+                    stats.busy += clock() - t
+                    n += 1
+                    if progress and n >= progress._nextCheck:
+                        stats.items = n
+                        progress.update(n,self.bytesRead())
+                    yield rec
+            else:
+                for rec in records:
+                    n += 1
+                    if progress and n >= progress._nextCheck:
+                        progress.update(n,self.bytesRead())
+                    yield rec
+        finally:
+            stats.items = n
+            stats.stopped = time.time()
+            stats.bytes = self.bytesRead()
+            if progress:
+                progress.report(n,stats.bytes,final=True)
+
+
+class InstrumentedWriter(object):
+    """File-like wrapper timing write() calls and counting lines (items)
+    and bytes written."""
+    def __init__(self,outFile,name='write'):
+        self.outFile = outFile
+        self.stats = StageStats(name)
+        self.stats.bytes = 0
+        self.stats.started = time.time()
+
+    def write(self,text):
+        t = time.time()
+        self.outFile.write(text)
+        self.stats.busy += time.time() - t
+        self.stats.bytes += len(text)
+        self.stats.items += text.count('\n')
+        self.stats.batches += 1
+        self.stats.stopped = time.time()
+
+    def flush(self):
+        self.outFile.flush()
+
+
+def stageReport(stagesList,started=None):
+    """Returns one line per StageStats in <stagesList> and a total/peak RSS line."""
+    lines = []
+    for stats in stagesList:
+        line = '%-20s %12d recs %9.2fs busy %9.2fs wall %12.1f recs/s' % \
+               (stats.name,stats.items,stats.busy,stats.wallTime(),stats.throughput())
+        if getattr(stats,'bytes',None):
+            line += ' %10.1f MB' % (stats.bytes/1048576.0)
+        lines.append(line)
+    if started is not None:
+        lines.append('%-20s %9.2fs wall %9.1f MB peak RSS' % ('total',time.time()-started,peakRssMB()))
+    return '\n'.join(lines)
+
+
+class Profiler(object):
+    """Context manager writing profile summaries of the code it wraps:
+    <outPrefix>.prof   cProfile stats (for pstats/snakeviz),
+    <outPrefix>.txt    top <top> funcs by cumulative time and a memory
+                       summary: tracemalloc top allocation sites where the
+                       module exists (python 3, or the pytracemalloc
+                       backport), otherwise peak RSS and the most common
+                       live object types."""
+    def __init__(self,outPrefix,top=40):
+        self.outPrefix = outPrefix
+        self.top = top
+
+    def __enter__(self):
+        import cProfile
+        try:
+            import tracemalloc
+            tracemalloc.start()
+            self._tracemalloc = tracemalloc
+        except ImportError:
+            self._tracemalloc = None
+        self._profile = cProfile.Profile()
+        self._started = time.time()
+        self._profile.enable()
+        return self
+
+    def __exit__(self,excType,exc,tb):
+        self._profile.disable()
+        wall = time.time() - self._started
+        import pstats
+        import StringIO
+        self._profile.dump_stats(self.outPrefix + '.prof')
+        text = StringIO.StringIO()
+        print >> text, 'wall time: %.2fs   peak RSS: %.1f MB\n' % (wall,peakRssMB())
+        pstats.Stats(self._profile, stream=text).sort_stats('cumulative').print_stats(self.top)
+        print >> text, '\n++++ memory ++++'
+        if self._tracemalloc:
+            snapshot = self._tracemalloc.take_snapshot()
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                print >> text, stat
+            self._tracemalloc.stop()
+        else:
+            import gc
+            counts = {}
+            for obj in gc.get_objects():
+                kind = type(obj).__name__
+                counts[kind] = counts.get(kind,0) + 1
+            print >> text, 'tracemalloc not available; most common live object types:'
+            for kind,count in sorted(counts.items(), key=lambda x: -x[1])[:self.top]:
+                print >> text, '%12d %s' % (count,kind)
+        outFile = open(self.outPrefix + '.txt','w')
+        outFile.write(text.getvalue())
+        outFile.close()
+        return False
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+    def __exit__(self,excType,exc,tb):
+        return False
+
+def maybeProfile(outPrefix):
+    """Returns Profiler(<outPrefix>), or a do-nothing context if it is None
+    (eg. straight from a --profile option)."""
+    if outPrefix:
+        return Profiler(outPrefix)
+    return _NullContext()
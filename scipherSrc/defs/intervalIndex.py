@@ -0,0 +1,234 @@
+import numpy as np
+
+from scipherSrc.defs.compressedIO import openInput
+
+# -- max candidate pairs expanded at once by overlapPairs --
+_PAIR_BATCH = 1 << 20
+
+class _ContigIntervals(object):
+    """Sorted arrays for the intervals of one contig."""
+    def __init__(self,starts,stops,ids):
+        order = np.argsort(starts, kind='mergesort')
+        self.starts = starts[order]
+        self.stops  = stops[order]
+        self.ids    = ids[order]
+        self.sortedStops = np.sort(self.stops)
+        # -- length classes [2**k,2**(k+1)): each searched with its own max
+        #    length, so a few very long intervals don't widen every window --
+        lens = self.stops - self.starts + 1
+        lenClass = np.log2(lens.astype(np.float64)).astype(np.int64)
+        self.lenClasses = []
+        for k in np.unique(lenClass):
+            m = lenClass == k
+            self.lenClasses.append((self.starts[m],self.stops[m],np.flatnonzero(m),int(lens[m].max())))
+        # -- for coverage: prefix sums of sorted starts and of sorted ends (stop+1) --
+        self.startCum = np.concatenate(([0],np.cumsum(self.starts)))
+        self.endCum   = np.concatenate(([0],np.cumsum(self.sortedStops + 1)))
+
+
+class IntervalIndex(object):
+    """Index of closed intervals [start,stop] grouped by contig.
+    Each contig keeps its intervals in arrays sorted by start (and a sorted
+    copy of the stops), so every query below is a handful of vectorized
+    binary searches over a whole array of query intervals.
+    Interval ids are their positions in the arrays given to the constructor."""
+    def __init__(self,contigs,starts,stops,names=None):
+        """<contigs>: seq of contig names, one per interval.
+        <starts>,<stops>: int seqs (closed intervals).
+        <names>: optional seq of feature names kept alongside."""
+        contigs = np.asarray(contigs)
+        starts  = np.asarray(starts, dtype=np.int64)
+        stops   = np.asarray(stops, dtype=np.int64)
+        if (stops < starts).any():
+            raise Exception("**ERROR** every interval must have stop >= start.")
+        self.names = names
+        self.starts = starts
+        self.stops  = stops
+        self._contigs = {}
+        ids = np.arange(len(starts))
+        if len(starts):
+            uniq,inverse = np.unique(contigs, return_inverse=True)
+            for code,ctg in enumerate(uniq):
+                mask = inverse == code
+                self._contigs[ctg] = _ContigIntervals(starts[mask],stops[mask],ids[mask])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def contigs(self):
+        return self._contigs.keys()
+
+    @classmethod
+    def fromCoords(cls,coordIter):
+        """Builds index from (contig,start,stop) tuples, eg. the _parseCoords
+        output of ParseBowtieMap/ParseSolexaSorted."""
+        contigs,starts,stops = [],[],[]
+        for ctg,start,stop in coordIter:
+            contigs.append(ctg)
+            starts.append(start)
+            stops.append(stop)
+        return cls(contigs,starts,stops)
+
+    @classmethod
+    def fromAlignments(cls,alns):
+        """Builds index from an alignmentArrays.AlignmentArrays table."""
+        contigs = np.array(alns.contigs, dtype=object)[alns.contigCodes] if len(alns) else []
+        return cls(contigs,alns.starts,alns.stops)
+
+    @classmethod
+    def fromBED(cls,bedPath,blocks=False):
+        """Builds index from a BED file (eg. namedTable2BED output).
+        BED's 0-based half-open [start,end) becomes closed [start,end-1].
+        With <blocks>, each BED12 block becomes its own interval (named after
+        its feature), so reads are matched against exons, not whole spans."""
+        contigs,starts,stops,names = [],[],[],[]
+        for line in openInput(bedPath):
+            if line.startswith(('track','browser','#')) or not line.strip():
+                continue
+            f = line.rstrip('\n').split('\t')
+            ctg,start,end = f[0],int(f[1]),int(f[2])
+            name = f[3] if len(f) > 3 else None
+            if blocks and len(f) >= 12:
+                sizes  = [int(x) for x in f[10].strip(',').split(',')]
+                offset = [int(x) for x in f[11].strip(',').split(',')]
+                for size,off in zip(sizes,offset):
+                    contigs.append(ctg)
+                    starts.append(start + off)
+                    stops.append(start + off + size - 1)
+                    names.append(name)
+            else:
+                contigs.append(ctg)
+                starts.append(start)
+                stops.append(end - 1)
+                names.append(name)
+        return cls(contigs,starts,stops,names)
+
+    def _queryArrays(self,qStarts,qStops):
+        qStarts = np.atleast_1d(np.asarray(qStarts, dtype=np.int64))
+        if qStops is None:
+            qStops = qStarts
+        qStops = np.atleast_1d(np.asarray(qStops, dtype=np.int64))
+        return qStarts,qStops
+
+    def countOverlaps(self,contig,qStarts,qStops=None):
+        """Returns int array: number of intervals on <contig> overlapping each
+        query [qStart,qStop] (qStops default to qStarts, ie. point queries).
+        #(start <= qStop) - #(stop < qStart) needs no per-interval work."""
+        qStarts,qStops = self._queryArrays(qStarts,qStops)
+        c = self._contigs.get(contig)
+        if c is None:
+            return np.zeros(len(qStarts), dtype=np.int64)
+        return np.searchsorted(c.starts, qStops, 'right') - np.searchsorted(c.sortedStops, qStarts, 'left')
+
+    def overlapPairs(self,contig,qStarts,qStops=None):
+        """Returns (queryIdx,intervalId) int arrays listing every overlapping
+        pair between the queries and the intervals on <contig>, ordered by
+        query then interval start.
+        Each length class of intervals is searched separately and queries
+        are expanded in batches of ~_PAIR_BATCH candidates, so memory stays
+        bounded by the output size, not by the longest interval."""
+        qStarts,qStops = self._queryArrays(qStarts,qStops)
+        c = self._contigs.get(contig)
+        empty = np.zeros(0, dtype=np.int64)
+        if c is None or not len(qStarts):
+            return empty,empty
+        # -- searching with sorted queries is far more cache friendly --
+        qOrder = np.argsort(qStarts)
+        qStarts,qStops = qStarts[qOrder],qStops[qOrder]
+        outQ,outP = [],[]
+        for starts,stops,positions,maxLen in c.lenClasses:
+            # -- candidates: intervals starting in [qStart-maxLen+1, qStop] --
+            lo = np.searchsorted(starts, qStarts - maxLen + 1, 'left')
+            hi = np.searchsorted(starts, qStops, 'right')
+            n  = np.maximum(hi - lo, 0)
+            cum = np.cumsum(n)
+            b0 = 0
+            while b0 < len(n):
+                done = cum[b0-1] if b0 else 0
+                b1 = max(int(np.searchsorted(cum, done + _PAIR_BATCH, 'right')), b0 + 1)
+                bn = n[b0:b1]
+                total = int(bn.sum())
+                if total:
+                    qIdx = np.repeat(np.arange(b0,b1), bn)
+                    runStarts = np.repeat(np.cumsum(bn) - bn, bn)
+                    pos  = np.repeat(lo[b0:b1], bn) + (np.arange(total) - runStarts)
+                    keep = stops[pos] >= qStarts[qIdx]
+                    outQ.append(qOrder[qIdx[keep]])
+                    outP.append(positions[pos[keep]])
+                b0 = b1
+        if not outQ:
+            return empty,empty
+        qIdx = np.concatenate(outQ)
+        cPos = np.concatenate(outP)
+        order = np.argsort(qIdx * len(c.starts) + cPos)
+        return qIdx[order],c.ids[cPos[order]]
+
+    def nearest(self,contig,qStarts,qStops=None):
+        """Returns (intervalId,distance) int arrays for the interval on
+        <contig> closest to each query (distance 0 == overlap).
+        intervalId is -1 if <contig> has no intervals."""
+        qStarts,qStops = self._queryArrays(qStarts,qStops)
+        nQ = len(qStarts)
+        c = self._contigs.get(contig)
+        if c is None:
+            return -np.ones(nQ, dtype=np.int64),-np.ones(nQ, dtype=np.int64)
+        big = np.iinfo(np.int64).max
+
+        # -- closest interval ending before the query (by stop) --
+        stopOrder = np.argsort(c.stops, kind='mergesort')
+        li = np.searchsorted(c.sortedStops, qStarts, 'left') - 1
+        hasLeft = li >= 0
+        leftPos = stopOrder[np.maximum(li,0)]
+        leftDist = np.where(hasLeft, qStarts - c.stops[leftPos], big)
+
+        # -- closest interval starting after the query --
+        ri = np.searchsorted(c.starts, qStops, 'right')
+        hasRight = ri < len(c.starts)
+        rightPos = np.minimum(ri, len(c.starts)-1)
+        rightDist = np.where(hasRight, c.starts[rightPos] - qStops, big)
+
+        ids  = np.where(leftDist <= rightDist, c.ids[leftPos], c.ids[rightPos])
+        dist = np.minimum(leftDist, rightDist)
+
+        # -- overlapping queries: distance 0, report the last-starting overlap --
+        overlap = (np.searchsorted(c.starts, qStops, 'right') - np.searchsorted(c.sortedStops, qStarts, 'left')) > 0
+        if overlap.any():
+            qi,iid = self.overlapPairs(contig,qStarts[overlap],qStops[overlap])
+            pick = np.zeros(overlap.sum(), dtype=np.int64)
+            pick[qi] = iid
+            ids[overlap]  = pick
+            dist[overlap] = 0
+        return ids,dist
+
+    def coveredBases(self,contig,positions):
+        """Returns total interval bases (summed depth) lying before each
+        position in <positions> on <contig>."""
+        x = np.asarray(positions, dtype=np.int64)
+        c = self._contigs.get(contig)
+        if c is None:
+            return np.zeros(len(x), dtype=np.int64)
+        nS = np.searchsorted(c.starts, x, 'left')
+        nE = np.searchsorted(c.sortedStops + 1, x, 'left')
+        return (x*nS - c.startCum[nS]) - (x*nE - c.endCum[nE])
+
+    def coverage(self,contig,binSize,length=None,start=0):
+        """Returns float array of mean depth in consecutive bins of <binSize>
+        from <start> to <length> (default: last interval stop on <contig>)."""
+        c = self._contigs.get(contig)
+        if length is None:
+            length = int(c.sortedStops[-1]) + 1 if c is not None else start
+        edges = np.arange(start, length + binSize, binSize)
+        edges[-1] = min(edges[-1], length)
+        if len(edges) < 2:
+            return np.zeros(0)
+        covered = self.coveredBases(contig,edges)
+        return np.diff(covered) / np.diff(edges).astype(np.float64)
+
+    def countHits(self,other):
+        """Returns int array: for each interval in self, the number of
+        intervals in IntervalIndex <other> overlapping it.
+        Exmpl: featIdx.countHits(IntervalIndex.fromAlignments(alns)) == reads per feature."""
+        counts = np.zeros(len(self), dtype=np.int64)
+        for ctg,c in self._contigs.items():
+            counts[c.ids] = other.countOverlaps(ctg,c.starts,c.stops)
+        return counts
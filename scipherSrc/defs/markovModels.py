@@ -1,43 +1,410 @@
 import random
 import bisect
 
+import numpy as np
+
 from scipherSrc.defs.basicDefs import slidingWindow
+from scipherSrc.defs.seqEncoding import DNA,BAD_CODE,encodeSeq,kmerCodes
+
+def _numpyRng(seed):
+    """Returns numpy RandomState seeded with <seed>, or, if it is None, from
+    the module-level random generator so random.seed(x) still makes the
+    draws reproducible."""
+    if seed is None:
+        seed = random.getrandbits(32)
+    return np.random.RandomState(seed)
+
 
 class WeightedRandomGenerator(object):
-    def __init__(self, weights):
+    def __init__(self, weights, seed=None):
+        """Draws indexes of <weights> with prob proportional to each weight.
+        <seed> makes draws reproducible; without it next() uses the
+        module-level random generator, as before."""
         self.totals = []
         running_total = 0
         for w in weights:
             running_total += w
             self.totals.append(running_total)
+        self._seed = seed
+        self._rnd = random.Random(seed) if seed is not None else random
+        self._rng = None
     def next(self):
-        rnd = random.random() * self.totals[-1]
+        rnd = self._rnd.random() * self.totals[-1]
         return bisect.bisect_right(self.totals, rnd)
     def __call__(self):
         return self.next()
+    def draw(self, n):
+        """Returns int array of <n> draws made in bulk."""
+        # -- made on first use so next()-only callers leave random's stream untouched --
+        if self._rng is None:
+            self._rng = _numpyRng(self._seed)
+        rnd = self._rng.random_sample(n) * self.totals[-1]
+        return np.searchsorted(self.totals, rnd, side='right')
+
+
+def buildAliasTable(weights):
+    """Returns (prob,alias) arrays of Vose's alias method for <weights>."""
+    w = np.asarray(weights, dtype=np.float64)
+    K = len(w)
+    prob  = np.zeros(K)
+    alias = np.arange(K)
+    scaled = w * K / w.sum()
+    small = [i for i in range(K) if scaled[i] < 1.0]
+    large = [i for i in range(K) if scaled[i] >= 1.0]
+    while small and large:
+        l = small.pop()
+        g = large.pop()
+        prob[l]  = scaled[l]
+        alias[l] = g
+        scaled[g] = (scaled[g] + scaled[l]) - 1.0
+        if scaled[g] < 1.0:
+            small.append(g)
+        else:
+            large.append(g)
+    # -- leftovers are 1.0 up to rounding --
+    for i in large + small:
+        prob[i] = 1.0
+    return prob,alias
+
+
+class AliasSampler(object):
+    """O(1)-per-draw weighted sampler built once from <weights>."""
+    def __init__(self, weights, seed=None):
+        self.prob,self.alias = buildAliasTable(weights)
+        self._rng = _numpyRng(seed)
+    def draw(self, n):
+        """Returns int array of <n> indexes drawn in bulk."""
+        i = self._rng.randint(len(self.prob), size=n)
+        return np.where(self._rng.random_sample(n) < self.prob[i], i, self.alias[i])
+    def next(self):
+        return int(self.draw(1)[0])
+    def __call__(self):
+        return self.next()
+
+
+class MkvChainSampler(object):
+    """Markov chain generator compiled once from an nOrdMkvBkg dict.
+    Every context gets an alias table row and a row of next-context
+    indexes, so each step of every chain is a few integer array lookups."""
+    def __init__(self, mkBkg, seed=None):
+        """<mkBkg> is bkg[ctxTuple][nextSym] = (count,freqTot,freqGroup).
+        <seed> makes generated chains reproducible."""
+        self.contexts = list(mkBkg)
+        self._ctxIdx  = dict([(c,i) for i,c in enumerate(self.contexts)])
+        symbols = set()
+        for c in self.contexts:
+            symbols.update(mkBkg[c])
+        self.symbols = sorted(symbols)
+        symIdx = dict([(x,i) for i,x in enumerate(self.symbols)])
+        C = len(self.contexts)
+        K = len(self.symbols)
+        
+        self.prob    = np.zeros((C,K))
+        self.alias   = np.zeros((C,K), dtype=np.intp)
+        self.nextCtx = np.empty((C,K), dtype=np.intp)
+        self.nextCtx.fill(-1)  # -1 == chain walked into an unseen context
+        for i,ctx in enumerate(self.contexts):
+            weights = np.zeros(K)
+            for sym,vals in mkBkg[ctx].items():
+                weights[symIdx[sym]] = vals[2]
+                # -- order 0: the only context is () and every step returns to it --
+                nextKey = ctx[1:] + (sym,) if ctx else ()
+                self.nextCtx[i,symIdx[sym]] = self._ctxIdx.get(nextKey,-1)
+            self.prob[i],self.alias[i] = buildAliasTable(weights)
+        self._rng = _numpyRng(seed)
+    
+    def reseed(self, seed=None):
+        """Restarts the random stream as if built with <seed>."""
+        self._rng = _numpyRng(seed)
+    
+    def generateCodes(self, seed, length, n=1):
+        """Returns n x length int array of symbol indexes (into self.symbols)
+        for <n> chains all started from context <seed>.  Random numbers for
+        all chains and steps are drawn in bulk up front."""
+        try:
+            c = np.empty(n, dtype=np.intp)
+            c.fill(self._ctxIdx[tuple(seed)])
+        except KeyError:
+            raise KeyError(tuple(seed))
+        K = self.prob.shape[1]
+        picks = self._rng.randint(K, size=(length,n))
+        coins = self._rng.random_sample((length,n))
+        out = np.empty((length,n), dtype=np.intp)
+        for t in range(length):
+            k = picks[t]
+            sym = np.where(coins[t] < self.prob[c,k], k, self.alias[c,k])
+            out[t] = sym
+            if t+1 < length:
+                c = self.nextCtx[c,sym]
+                if (c < 0).any():
+                    bad = np.flatnonzero(c < 0)[0]
+                    raise KeyError("chain %s reached a context not seen in the model." % (bad))
+        return out.T
+    
+    def generate(self, seed, length, n=1):
+        """Returns list of <n> chains: each is list(seed) + <length> new symbols."""
+        codes = self.generateCodes(seed, length, n)
+        return [list(seed) + [self.symbols[k] for k in row] for row in codes]
 
-def nOrdMkvBkg(order,seqList):
+
+class MkvCounts(object):
+    """Dense table of (order+1)-mer counts for an 'order'^th order markov model.
+    counts[ctxCode*len(alphabet) + symCode] holds the number of times symbol
+    followed context; kmer codes come from seqEncoding.kmerCodes."""
+    maxTableSize = 4**13
+    
+    def __init__(self,order,alphabet=DNA,counts=None):
+        """<alphabet> is a str of single char symbols (DNA default: 2-bit codes)
+        or a list of arbitrary hashable symbols (eg. words)."""
+        self.order    = order
+        self.alphabet = alphabet
+        self.base     = len(alphabet)
+        size = self.base**(order+1)
+        if counts is None:
+            if size > self.maxTableSize:
+                raise Exception("**ERROR** dense table of %s cells is too large for order %s over %s symbols." % (size,order,self.base))
+            counts = np.zeros(size, dtype=np.int64)
+        elif len(counts) != size:
+            raise Exception("**ERROR** counts must have length len(alphabet)**(order+1).")
+        self.counts = counts
+    
+    def addSeq(self,seq):
+        """Counts every (order+1)-length window of <seq>.  Windows holding
+        symbols not in the alphabet are skipped, as are seqs shorter than
+        one window.
+        packedSeq.PackedSeq objects are read straight from their packed
+        bytes when the alphabet is DNA."""
+        if hasattr(seq,'dnaCodes'):
+            if list(self.alphabet) == list(DNA):
+                codes = seq.dnaCodes()
+            else:
+                codes = encodeSeq(seq.fetch(),self.alphabet)
+        else:
+            codes = encodeSeq(seq,self.alphabet)
+        kmers,valid = kmerCodes(codes,self.order+1,self.base)
+        if len(kmers):
+            self._addCounts(np.bincount(kmers[valid], minlength=len(self.counts)))
+        return self
+    
+    def _addCounts(self,counts):
+        # -- tables loaded read-only (mmap) are copied on first update --
+        if not self.counts.flags.writeable:
+            self.counts = np.array(self.counts)
+        self.counts += counts
+    
+    def addSeqs(self,seqList):
+        for seq in seqList:
+            self.addSeq(seq)
+        return self
+    
+    def _checkCompatible(self,other):
+        if not isinstance(other,MkvCounts) or other.order != self.order or \
+           list(other.alphabet) != list(self.alphabet):
+            raise Exception("**ERROR** can only combine MkvCounts of the same order and alphabet.")
+    
+    def __iadd__(self,other):
+        """Adds counts of <other> (eg. from another chunk or corpus) into self."""
+        self._checkCompatible(other)
+        self._addCounts(other.counts)
+        return self
+    
+    def __add__(self,other):
+        self._checkCompatible(other)
+        return MkvCounts(self.order,self.alphabet,self.counts + other.counts)
+    
+    def __radd__(self,other):
+        # -- lets sum() start from 0 --
+        if other == 0:
+            return MkvCounts(self.order,self.alphabet,self.counts.copy())
+        return self.__add__(other)
+    
+    def totalWindows(self):
+        return int(self.counts.sum())
+    
+    def _ctxTuple(self,ctxCode):
+        ctx = []
+        for i in range(self.order):
+            ctxCode,symCode = divmod(ctxCode,self.base)
+            ctx.append(self.alphabet[symCode])
+        return tuple(reversed(ctx))
+    
+    def _ctxCode(self,ctx):
+        code = 0
+        for sym in ctx:
+            code = code*self.base + self.alphabet.index(sym)
+        return code
+    
+    def context(self,ctx):
+        """Returns {nextSym:(count,freqTot,freqGroup)} for context tuple <ctx>,
+        ie. the same as nOrdMkvBkg(...)[ctx].  Raises KeyError if unseen."""
+        try:
+            ctxCode = self._ctxCode(ctx)
+        except ValueError:
+            raise KeyError(ctx)
+        if len(ctx) != self.order:
+            raise KeyError(ctx)
+        return self._groupDict(ctxCode,float(self.totalWindows()))
+    
+    def _groupDict(self,ctxCode,totWin):
+        row = self.counts[ctxCode*self.base:(ctxCode+1)*self.base]
+        totGroup = row.sum()
+        if not totGroup:
+            raise KeyError(self._ctxTuple(ctxCode))
+        group = {}
+        for symCode in np.flatnonzero(row):
+            count = int(row[symCode])
+            group[self.alphabet[symCode]] = (count,count/totWin,float(count)/totGroup)
+        return group
+    
+    def save(self,basePath,sourceHash=None):
+        """Writes counts to basePath+'.npy' and order/alphabet/<sourceHash>
+        metadata to basePath+'.json'.  Both are written to temp names and
+        renamed into place, so readers never see a half-written model."""
+        import os
+        import json
+        meta = {'order':self.order,
+                'alphabet':list(self.alphabet),
+                'alphabetIsStr':isinstance(self.alphabet,str),
+                'sourceHash':sourceHash,
+                'totalWindows':self.totalWindows()}
+        tmpNpy = '%s.%s.tmp.npy' % (basePath,os.getpid())
+        np.save(tmpNpy, np.asarray(self.counts, dtype=np.int64))
+        os.rename(tmpNpy, basePath + '.npy')
+        tmpJson = '%s.%s.tmp.json' % (basePath,os.getpid())
+        jsonFile = open(tmpJson, 'w')
+        json.dump(meta, jsonFile)
+        jsonFile.close()
+        os.rename(tmpJson, basePath + '.json')
+    
+    @classmethod
+    def load(cls,basePath,mmap=True):
+        """Loads a model written by save(); counts are memory-mapped
+        (read-only until the first update) if <mmap>.
+        Returns (mkvCounts,metadataDict)."""
+        import json
+        meta = json.load(open(basePath + '.json'))
+        alphabet = [x.encode('utf-8') for x in meta['alphabet']]
+        if meta['alphabetIsStr']:
+            alphabet = ''.join(alphabet)
+        counts = np.load(basePath + '.npy', mmap_mode='r' if mmap else None)
+        return cls(meta['order'],alphabet,counts),meta
+    
+    @classmethod
+    def fromBkg(cls,bkg,alphabet=DNA):
+        """Returns MkvCounts holding the counts of a nested dict built by
+        nOrdMkvBkg (symbols outside <alphabet> are dropped)."""
+        order = len(bkg.iterkeys().next()) if bkg else 0
+        mkv = cls(order,alphabet)
+        symCodes = dict([(sym,i) for i,sym in enumerate(alphabet)])
+        for ctx,group in bkg.iteritems():
+            try:
+                ctxCode = mkv._ctxCode(ctx)
+            except ValueError:
+                continue
+            for sym,stats in group.iteritems():
+                if sym in symCodes:
+                    mkv.counts[ctxCode*mkv.base + symCodes[sym]] += stats[0]
+        return mkv
+    
+    def logProbTable(self,pseudocount=1.0):
+        """Returns float64 array, same layout as counts, of
+        log P(sym|ctx) = log((count+pseudocount)/(ctxTotal+base*pseudocount)).
+        With <pseudocount>=0 unseen transitions get -inf."""
+        rows = self.counts.reshape(-1,self.base).astype(np.float64) + pseudocount
+        tots = rows.sum(axis=1)[:,None]
+        old = np.seterr(divide='ignore', invalid='ignore')
+        try:
+            table = np.log(rows) - np.log(tots)
+        finally:
+            np.seterr(**old)
+        # -- contexts never seen (and no pseudocount) carry no information --
+        table[(tots == 0).ravel()] = -np.log(self.base)
+        return table.ravel()
+    
+    def toBkg(self):
+        """Returns the nested dict built by nOrdMkvBkg:
+        bkg[ctxTuple][nextSym] = (count,freqTot,freqGroup)"""
+        totWin = float(self.totalWindows())
+        groupTots = self.counts.reshape(-1,self.base).sum(axis=1)
+        bkg = {}
+        for ctxCode in np.flatnonzero(groupTots):
+            bkg[self._ctxTuple(ctxCode)] = self._groupDict(ctxCode,totWin)
+        return bkg
+
+
+def nOrdMkvCounts(order,seqList,alphabet=DNA):
+    """Returns MkvCounts for 'order'^th order background of seqs in 'seqList'."""
+    return MkvCounts(order,alphabet).addSeqs(seqList)
+
+def _countSeqChunk(args):
+    """Pool worker: returns the counts array for one chunk of seqs."""
+    order,alphabet,seqs = args
+    return nOrdMkvCounts(order,seqs,alphabet).counts
+
+def _chunkSeqs(seqIter,chunkBases):
+    """Yields lists of seqs holding roughly <chunkBases> symbols each.
+    Items of <seqIter> may be seqs or (name,seq) tuples (eg. from ParseFastA)."""
+    chunk = []
+    size  = 0
+    for seq in seqIter:
+        if isinstance(seq,tuple):
+            seq = seq[1]
+        if not seq:
+            continue
+        chunk.append(seq)
+        size += len(seq)
+        if size >= chunkBases:
+            yield chunk
+            chunk = []
+            size  = 0
+    if chunk:
+        yield chunk
+
+def parallelMkvCounts(order,seqIter,alphabet=DNA,processes=None,chunkBases=2*1024*1024,counts=None):
+    """Returns MkvCounts built by sharding <seqIter> across a process pool.
+    <seqIter> may be any iterable of seqs or (name,seq) records, so a
+    ParseFastA instance can be streamed straight in.  Chunks of ~<chunkBases>
+    symbols are counted in the workers and summed here; pass an existing
+    MkvCounts as <counts> to add a new corpus to it without recounting.
+    Normalize once at the end with .toBkg()."""
+    import multiprocessing
+    if counts is None:
+        counts = MkvCounts(order,alphabet)
+    jobs = ((order,alphabet,chunk) for chunk in _chunkSeqs(seqIter,chunkBases))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunkCounts in pool.imap_unordered(_countSeqChunk,jobs):
+            counts += MkvCounts(order,alphabet,chunkCounts)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counts
+
+def nOrdMkvBkg(order,seqList,alphabet=None):
     """Returns a dict representing the 'order'^th order background
     model of 'order' length substrings in 'seqList'.
     bkg[i-order:-1][i] = (count,freqTot,freqGroup)
-    """   
+    
+    If <alphabet> is given (eg. 'ACGT'), counting is done with the vectorized
+    MkvCounts backend, and windows with symbols outside <alphabet> are skipped.
+    """
+    if alphabet is not None:
+        return nOrdMkvCounts(order,seqList,alphabet).toBkg()
+    
     bkg = {}
     totWin = 0
     for seq in seqList:
         windows = slidingWindow(sequence=seq,winSize=order+1,step=1)
         for win in windows:
-            try:
-                bkg[tuple(win[:-1])]
-                try:
-                    bkg[tuple(win[:-1])][win[-1]] += 1
-                    totWin += 1
-                except KeyError:
-                    bkg[tuple(win[:-1])][win[-1]] = 1
-                    totWin += 1
-            except KeyError:
-                bkg[tuple(win[:-1])] = {}
-                bkg[tuple(win[:-1])][win[-1]] = 1
-                totWin += 1
+            ctx   = tuple(win[:-1])
+            group = bkg.get(ctx)
+            if group is None:
+                group = bkg[ctx] = {}
+            group[win[-1]] = group.get(win[-1],0) + 1
+            totWin += 1
     for k in bkg:
         totGroup = 0
         for j in bkg[k]:
@@ -47,17 +414,327 @@ def nOrdMkvBkg(order,seqList):
             bkg[k][j] = (count,float(count)/totWin,float(count)/totGroup)
     return bkg
 
-def buildMarkovTxt(mkBkg,seed,length=100):
-    """Given a <seed> of correct length, use the <mkBkg> to produce a markov chain of length <length>"""
-    win = len(seed)
-    chain = seed[:]
-    for i in range(length):
-        print tuple(chain[-win:])
-        nextOptions = mkBkg[tuple(chain[-win:])].items()
-        rand = WeightedRandomGenerator([x[1][2] for x in nextOptions])
-        chain.append(nextOptions[rand()][0])
+class MkvScorer(object):
+    """Scores seqs against a compiled markov background (and optionally a
+    foreground) with array lookups instead of per-base dict walks.
+    The model is compiled once into a dense table of log P(sym|ctx)
+    indexed by seqEncoding.kmerCodes, so a seq's per-position scores are
+    table[kmerCodes(seq)].  With a foreground model, table holds the
+    log-odds log Pfg - log Pbkg.
+    Only the len(seq)-order windows with a full context are scored (the
+    first <order> symbols get no score); windows holding symbols outside
+    the alphabet score nan in tracks and 0 in totals.
+    Exmpl:
+        scorer = MkvScorer(nOrdMkvCounts(3,promoters),fg=nOrdMkvCounts(3,hits))
+        totals = scorer.scoreBatch(candidateSeqs)
+        perWin = scorer.windowScores(chrmSeq,winSize=500,step=50)"""
+    def __init__(self,bkg,fg=None,alphabet=DNA,pseudocount=1.0):
+        """<bkg>,<fg>: MkvCounts or nested dicts from nOrdMkvBkg (then
+        <alphabet> is used to compile them)."""
+        if not isinstance(bkg,MkvCounts):
+            bkg = MkvCounts.fromBkg(bkg,alphabet)
+        self.order    = bkg.order
+        self.alphabet = bkg.alphabet
+        self.base     = bkg.base
+        self.table    = bkg.logProbTable(pseudocount)
+        if fg is not None:
+            if not isinstance(fg,MkvCounts):
+                fg = MkvCounts.fromBkg(fg,self.alphabet)
+            bkg._checkCompatible(fg)
+            self.table = fg.logProbTable(pseudocount) - self.table
+    
+    def _codes(self,seq):
+        if hasattr(seq,'dnaCodes') and list(self.alphabet) == list(DNA):
+            return seq.dnaCodes()
+        return encodeSeq(seq,self.alphabet)
+    
+    def _lookup(self,codes):
+        """Returns (scores,valid) for the windows of <codes>; invalid windows score 0."""
+        kmers,valid = kmerCodes(codes,self.order+1,self.base)
+        scores = self.table[np.where(valid, kmers, 0)]
+        scores[~valid] = 0.0
+        return scores,valid
+    
+    def track(self,seq):
+        """Returns float array: score of each symbol i >= order of <seq>
+        given its context (nan where the window holds unknown symbols)."""
+        scores,valid = self._lookup(self._codes(seq))
+        scores[~valid] = np.nan
+        return scores
+    
+    def score(self,seq):
+        """Returns total log-likelihood (or log-odds) of <seq>."""
+        return float(self._lookup(self._codes(seq))[0].sum())
+    
+    def scoreBatch(self,seqs):
+        """Returns float array of score() for every seq in <seqs> (strs,
+        PackedSeqs or (name,seq) records), computed in a single lookup over
+        the concatenated seqs."""
+        codeList = []
+        for seq in seqs:
+            if isinstance(seq,tuple):
+                seq = seq[1]
+            codeList.append(self._codes(seq))
+            # -- a bad symbol between seqs keeps windows from spanning two seqs --
+            codeList.append(np.array([BAD_CODE], dtype=np.uint8))
+        if not codeList:
+            return np.zeros(0)
+        lengths = np.array([len(x) for x in codeList[::2]], dtype=np.int64)
+        scores,valid = self._lookup(np.concatenate(codeList))
+        cs = np.concatenate(([0.0],np.cumsum(scores)))
+        starts = np.concatenate(([0],np.cumsum(lengths + 1)[:-1]))
+        ends   = np.clip(starts + lengths - self.order, starts, len(scores))
+        return cs[ends] - cs[starts]
+    
+    def windowScores(self,seq,winSize,step=1):
+        """Returns (starts,scores): summed score of each <winSize> long window
+        of <seq> starting every <step> symbols, eg. every promoter-sized
+        window of a chromosome.  A window's score covers the symbols inside
+        it that have their whole context inside it too."""
+        if winSize <= self.order:
+            raise Exception("**ERROR** winSize must be larger than the model order (%s)." % (self.order))
+        scores,valid = self._lookup(self._codes(seq))
+        cs = np.concatenate(([0.0],np.cumsum(scores)))
+        starts = np.arange(0, len(scores) - (winSize - self.order) + 1, step)
+        return starts,cs[starts + winSize - self.order] - cs[starts]
+
+
+def _sortedLookup(keys,queries,*valueArrays):
+    """Returns list holding, for each array in <valueArrays>, values[i]
+    where keys[i] == query, else 0 (<keys> sorted)."""
+    if not len(keys):
+        return [np.zeros(np.shape(queries), dtype=v.dtype) for v in valueArrays]
+    idx = np.minimum(np.searchsorted(keys, queries), len(keys)-1)
+    found = keys[idx] == queries
+    return [np.where(found, v[idx], 0) for v in valueArrays]
+
+
+class SparseMkvModel(object):
+    """Variable-order markov model over orders 0..<maxOrder> that stores
+    only the (k+1)-mers it has seen: one sorted int64 array of kmer codes
+    (seqEncoding.kmerCodes) and one array of counts per order, so memory
+    follows the number of distinct kmers, not len(alphabet)**(maxOrder+1).
+    Probabilities are Witten-Bell interpolated from order 0 up to the
+    longest available context:
+      P_k(sym|ctx) = (c(ctx,sym) + T(ctx)*P_k-1(sym|ctx[1:])) / (c(ctx) + T(ctx))
+    where T(ctx) is the number of distinct symbols seen after ctx and
+    P_-1 is uniform, so unseen contexts and symbols never get zero.
+    Exmpl:
+        model = SparseMkvModel(10).addSeqs(seqs)
+        model.prune(2)
+        lp = model.logProbs(candidate)"""
+    def __init__(self,maxOrder,alphabet=DNA,maxEntries=None,flushKmers=4*1024*1024):
+        """<maxEntries>: while counting, raise the prune threshold whenever more
+        than this many kmers (all orders) are stored, keeping memory bounded
+        (counts of pruned kmers seen again later restart from 0).  Order 0 is
+        never pruned, so it must be at least len(<alphabet>).
+        <flushKmers>: kmers buffered before merging into the sorted arrays
+        (at most <maxEntries> when that is given)."""
+        if float(len(alphabet))**(maxOrder+1) >= 2**63:
+            raise Exception("**ERROR** order %s kmers over %s symbols do not fit an int64 code." % (maxOrder,len(alphabet)))
+        if maxEntries is not None and maxEntries < len(alphabet):
+            raise Exception("**ERROR** maxEntries (%s) must be at least the alphabet size (%s): order 0 is never pruned." % (maxEntries,len(alphabet)))
+        if maxEntries:
+            flushKmers = min(flushKmers,maxEntries)
+        self.maxOrder = maxOrder
+        self.alphabet = alphabet
+        self.base     = len(alphabet)
+        self.maxEntries = maxEntries
+        self.flushKmers = flushKmers
+        self.minCount = 1
+        self.keys   = [np.zeros(0, dtype=np.int64) for k in range(maxOrder+1)]
+        self.counts = [np.zeros(0, dtype=np.int64) for k in range(maxOrder+1)]
+        self._pending = [[] for k in range(maxOrder+1)]
+        self._pendingSize = 0
+        self._ctxStats = None
+    
+    def _codes(self,seq):
+        if hasattr(seq,'dnaCodes') and list(self.alphabet) == list(DNA):
+            return seq.dnaCodes()
+        return encodeSeq(seq,self.alphabet)
+    
+    def addSeq(self,seq):
+        """Counts every kmer of length 1..maxOrder+1 in <seq> (kmers holding
+        symbols outside the alphabet are skipped)."""
+        codes = self._codes(seq)
+        # -- long seqs (eg. chromosomes) are counted in slices so the buffers stay bounded --
+        step = max(self.flushKmers // (self.maxOrder+1),1)
+        for start in xrange(0,len(codes),step):
+            piece = codes[start:start+step+self.maxOrder]
+            for k in range(self.maxOrder+1):
+                kmers,valid = kmerCodes(piece,k+1,self.base)
+                kmers,valid = kmers[:step],valid[:step]
+                if len(kmers):
+                    self._pending[k].append(kmers[valid])
+                    self._pendingSize += len(kmers)
+            if self._pendingSize >= self.flushKmers:
+                self._flush()
+        self._ctxStats = None
+        return self
+    
+    def addSeqs(self,seqList):
+        for seq in seqList:
+            if isinstance(seq,tuple):
+                seq = seq[1]
+            self.addSeq(seq)
+        return self
+    
+    def _flush(self):
+        for k in range(self.maxOrder+1):
+            if not self._pending[k]:
+                continue
+            newKeys,newCounts = np.unique(np.concatenate(self._pending[k]), return_counts=True)
+            self._pending[k] = []
+            keys = np.concatenate((self.keys[k],newKeys))
+            counts = np.concatenate((self.counts[k],newCounts))
+            self.keys[k],inverse = np.unique(keys, return_inverse=True)
+            self.counts[k] = np.bincount(inverse, weights=counts).astype(np.int64)
+        self._pendingSize = 0
+        if self.maxEntries and self._storedEntries() > self.maxEntries:
+            # -- smallest threshold leaving at most maxEntries; order 0 is never pruned --
+            allowed = self.maxEntries - len(self.keys[0])
+            counts = np.sort(np.concatenate(self.counts[1:]))[::-1]
+            self.prune(int(counts[allowed]) + 1)
+    
+    def _storedEntries(self):
+        return sum([len(x) for x in self.keys])
+    
+    def entries(self):
+        """Number of stored kmers over all orders (buffered kmers are
+        merged first)."""
+        if self._pendingSize:
+            self._flush()
+        return self._storedEntries()
+    
+    def nbytes(self):
+        if self._pendingSize:
+            self._flush()
+        return sum([x.nbytes for x in self.keys + self.counts])
+    
+    def prune(self,minCount):
+        """Drops kmers of order >= 1 seen fewer than <minCount> times
+        (order 0 is always kept).  Their mass is then covered by backoff."""
+        if self._pendingSize:
+            self._flush()
+        for k in range(1,self.maxOrder+1):
+            keep = self.counts[k] >= minCount
+            self.keys[k],self.counts[k] = self.keys[k][keep],self.counts[k][keep]
+        self.minCount = max(self.minCount,minCount)
+        self._ctxStats = None
+        return self
+    
+    def _stats(self):
+        """Returns per order (ctxKeys,ctxTotals,ctxTypes): for each stored
+        context, its total count and number of distinct next symbols
+        (order 0 has the single empty context 0)."""
+        if self._pendingSize:
+            self._flush()
+        if self._ctxStats is None:
+            self._ctxStats = []
+            for k in range(self.maxOrder+1):
+                ctx = self.keys[k] // self.base
+                if not len(ctx):
+                    empty = np.zeros(0, dtype=np.int64)
+                    self._ctxStats.append((empty,empty,empty))
+                    continue
+                # -- keys are sorted, so each context is one contiguous run --
+                starts = np.concatenate(([0],np.flatnonzero(np.diff(ctx)) + 1))
+                totals = np.add.reduceat(self.counts[k], starts)
+                types  = np.diff(np.concatenate((starts,[len(ctx)])))
+                self._ctxStats.append((ctx[starts],totals,types))
+        return self._ctxStats
+    
+    def _interpolate(self,p,k,ctxCodes,kmers):
+        """One Witten-Bell step: updates P_k-1 estimates <p> to P_k for
+        queries with a seen context."""
+        ctxKeys,totals,types = self._stats()[k]
+        C,T = _sortedLookup(ctxKeys,ctxCodes,totals,types)
+        c = _sortedLookup(self.keys[k],kmers,self.counts[k])[0]
+        if np.ndim(kmers) > np.ndim(C):
+            C,T = C[...,None],T[...,None]
+        return np.where(C > 0, (c + T*p) / np.maximum(C + T,1), p)
+    
+    def probs(self,seq):
+        """Returns float array: P(seq[i]|seq[i-maxOrder:i]) for every i, using
+        the longest context available (shorter at the start of <seq> or
+        after an unknown symbol); nan where seq[i] is not in the alphabet."""
+        codes = self._codes(seq)
+        n = len(codes)
+        p = np.empty(n)
+        p.fill(1.0/self.base)
+        good = codes != BAD_CODE
+        for k in range(min(self.maxOrder,n-1)+1):
+            kmers,valid = kmerCodes(codes,k+1,self.base)
+            # -- windows with bad symbols get a context no stored kmer has --
+            kmers = np.where(valid, kmers, -1)
+            ctxCodes = np.where(valid, kmers // self.base, -1)
+            p[k:] = self._interpolate(p[k:],k,ctxCodes,kmers)
+        p[~good] = np.nan
+        return p
+    
+    def logProbs(self,seq):
+        return np.log(self.probs(seq))
+    
+    def score(self,seq):
+        """Returns log-likelihood of <seq> (unknown symbols are skipped)."""
+        lp = self.logProbs(seq)
+        return float(lp[~np.isnan(lp)].sum())
+    
+    def nextProbs(self,ctx):
+        """Returns float array over the alphabet: P(sym|<ctx>) using up to the
+        last maxOrder symbols of <ctx> (any length, even empty)."""
+        return self._nextProbs(self._codes(ctx)[None,:])[0]
+    
+    def _nextProbs(self,hist):
+        """<hist>: n x h array of context codes. Returns n x base probs."""
+        n,h = hist.shape
+        syms = np.arange(self.base, dtype=np.int64)
+        p = np.empty((n,self.base))
+        p.fill(1.0/self.base)
+        ctxCodes = np.zeros(n, dtype=np.int64)
+        for k in range(min(self.maxOrder,h)+1):
+            if k:
+                sym = hist[:,h-k].astype(np.int64)
+                # -- context code of the last k symbols: prepend one more symbol --
+                ctxCodes = np.where((sym == BAD_CODE) | (ctxCodes < 0), -1, ctxCodes + sym*self.base**(k-1))
+            kmers = np.where(ctxCodes[:,None] < 0, -1, ctxCodes[:,None]*self.base + syms[None,:])
+            p = self._interpolate(p,k,ctxCodes,kmers)
+        return p
+    
+    def generate(self,seed,length,n=1,rndSeed=None):
+        """Returns list of <n> chains: each is list(seed) + <length> new
+        symbols.  <seed> may be any length; contexts never seen simply back
+        off to lower orders, so generation never hits an unknown context."""
+        rng = _numpyRng(rndSeed)
+        hist = np.zeros((n,len(seed) + length), dtype=np.int64)
+        hist[:,:len(seed)] = self._codes(seed)
+        for t in range(len(seed),len(seed)+length):
+            p = self._nextProbs(hist[:,max(0,t-self.maxOrder):t])
+            cum = np.cumsum(p, axis=1)
+            draws = rng.random_sample(n)[:,None] * cum[:,-1:]
+            hist[:,t] = np.minimum((cum < draws).sum(axis=1), self.base-1)
+        return [list(seed) + [self.alphabet[k] for k in row[len(seed):]] for row in hist]
+
+
+def buildMarkovTxt(mkBkg,seed,length=100,rndSeed=None):
+    """Given a <seed> of correct length, use the <mkBkg> to produce a markov chain of length <length>.
+    <mkBkg> may also be a SparseMkvModel (then <seed> may be any length).
+    <rndSeed> makes the output reproducible.
+    The MkvChainSampler compiled from <mkBkg> is kept and reused while the
+    same <mkBkg> object is passed (do not edit it in between)."""
+    if isinstance(mkBkg,SparseMkvModel):
+        chain = mkBkg.generate(seed,length,rndSeed=rndSeed)[0]
+    else:
+        if _chainSamplerCache[0] is not mkBkg:
+            _chainSamplerCache[:] = [mkBkg,MkvChainSampler(mkBkg)]
+        sampler = _chainSamplerCache[1]
+        sampler.reseed(rndSeed)
+        chain = sampler.generate(seed,length)[0]
     return ' '.join(chain)
 
+# -- [mkBkg,MkvChainSampler] last compiled by buildMarkovTxt --
+_chainSamplerCache = [None,None]
+
 
 
 
@@ -77,7 +754,9 @@ def print_dptable(V):
             print "%.7s" % ("%f" % V[t][y]),
         print
  
-def viterbi(obs, states, start_p, trans_p, emit_p):
+def viterbi(obs, states, start_p, trans_p, emit_p, printTable=False):
+    """Textbook dict-based viterbi: returns (prob,pathList).
+    Use viterbiLog for long seqs (this one underflows after a few hundred obs)."""
     V = [{}]
     path = {}
  
@@ -99,11 +778,259 @@ def viterbi(obs, states, start_p, trans_p, emit_p):
         # Don't need to remember the old paths
         path = newpath
  
-    print_dptable(V)
+    if printTable:
+        print_dptable(V)
     (prob, state) = max([(V[len(obs) - 1][y], y) for y in states])
     return (prob, path[state])
 
 
+## Log-space matrix HMM ##
+
+def hmmToArrays(states, symbols, start_p, trans_p, emit_p):
+    """Converts the dict model used by viterbi into dense prob arrays.
+    Returns (start[S],trans[S,S],emit[S,O]) where rows/cols follow
+    the order of <states> and <symbols>.  Missing entries are prob 0."""
+    S = len(states)
+    start = np.array([start_p.get(y,0.0) for y in states], dtype=np.float64)
+    trans = np.array([[trans_p[y0].get(y,0.0) for y in states] for y0 in states], dtype=np.float64).reshape(S,S)
+    emit  = np.array([[emit_p[y].get(o,0.0) for o in symbols] for y in states], dtype=np.float64).reshape(S,len(symbols))
+    return start,trans,emit
+
+def arraysToHmm(states, symbols, start, trans, emit):
+    """Inverse of hmmToArrays: returns (start_p,trans_p,emit_p) dicts."""
+    start_p = dict([(y,float(start[i])) for i,y in enumerate(states)])
+    trans_p = dict([(y0,dict([(y,float(trans[i,j])) for j,y in enumerate(states)])) for i,y0 in enumerate(states)])
+    emit_p  = dict([(y,dict([(o,float(emit[i,k])) for k,o in enumerate(symbols)])) for i,y in enumerate(states)])
+    return start_p,trans_p,emit_p
+
+def hmmToLogArrays(states, symbols, start_p, trans_p, emit_p):
+    """As hmmToArrays but returns (logStart,logTrans,logEmit); prob 0 -> -inf."""
+    with np.errstate(divide='ignore'):
+        return tuple([np.log(x) for x in hmmToArrays(states, symbols, start_p, trans_p, emit_p)])
+
+def encodeObs(obs, symbols):
+    """Returns int array of indexes into <symbols> for each item of <obs>."""
+    symIdx = dict([(o,i) for i,o in enumerate(symbols)])
+    return np.array([symIdx[o] for o in obs], dtype=np.intp)
+
+def _bpDtype(S):
+    """Smallest int type able to hold a state index."""
+    if S <= 256:
+        return np.uint8
+    if S <= 65536:
+        return np.uint16
+    return np.int32
+
+def viterbiLog(obs, logStart, logTrans, logEmit, blockSize=4096):
+    """Log-space viterbi over integer-encoded <obs> (see encodeObs) and the
+    dense arrays from hmmToLogArrays.
+    Returns (logProb,statePathArray).  See viterbiBatch."""
+    logProb,paths = viterbiBatch([obs], logStart, logTrans, logEmit, blockSize)
+    return logProb[0],paths[0]
+
+def _composeSuffixes(M):
+    """Returns F with F[i] = M[i] o M[i+1] o ... o M[-1] (each M[i] a map
+    from state index to state index along the last axis), by doubling."""
+    F = M.copy()
+    n = len(F)
+    d = 1
+    while d < n:
+        F[:n-d] = np.take_along_axis(F[:n-d], F[d:].astype(np.intp), axis=-1)
+        d *= 2
+    return F
+
+def viterbiBatch(obsList, logStart, logTrans, logEmit, blockSize=4096):
+    """Decodes every integer-encoded seq in <obsList> together; seqs may
+    differ in length.
+    Returns (logProbArray,listOfStatePathArrays).
+    
+    Seqs are ordered longest first, so at each step the seqs still running
+    are a prefix of the batch: each step is one vectorized max/argmax over
+    that prefix only, and finished seqs cost nothing.  Backpointers are kept
+    per block of <blockSize> steps, sized to the seqs active in that block,
+    so memory follows the summed seq lengths, not len(obsList) x longest.
+    The traceback composes each block's backpointer maps by doubling
+    (log2(blockSize) array ops per block, no per-step loop)."""
+    obsList = [np.asarray(o, dtype=np.intp) for o in obsList]
+    B = len(obsList)
+    S = len(logStart)
+    if B == 0:
+        return np.zeros(0),[]
+    lengths = np.array([len(o) for o in obsList], dtype=np.intp)
+    if lengths.min() < 1:
+        raise Exception("**ERROR** every obs seq must hold at least one observation.")
+    order = np.argsort(-lengths, kind='mergesort')
+    negLens = -lengths[order]                                   # ascending
+    T = -negLens[0]
+    
+    emitT = logEmit.T                                           # O x S
+    V = logStart[None,:] + emitT[[obsList[b][0] for b in order]]   # B x S
+    scores = np.empty((B,S,S))
+    bpType = _bpDtype(S)
+    ident  = np.arange(S, dtype=bpType)
+    blocks = []
+    blkStart = 1
+    while blkStart < T:
+        # -- seqs still running at each step: those longer than it --
+        active = np.searchsorted(negLens, -np.arange(blkStart,min(T,blkStart+blockSize)), 'left')
+        nA = active[0]
+        # -- end the block early once half its seqs are done, bounding the padding --
+        n = max(int(np.searchsorted(-active, -(nA//2), 'right')),1) if nA > 1 else len(active)
+        n = min(n,len(active))
+        active = active[:n]
+        blkEnd = blkStart + n
+        obsBlk = np.zeros((n,nA), dtype=np.intp)
+        for r in range(nA):
+            o = obsList[order[r]][blkStart:blkEnd]
+            obsBlk[:len(o),r] = o
+        emits = emitT[obsBlk]                                   # n x nA x S
+        bp = np.empty((n,nA,S), dtype=bpType)
+        k = -1
+        for i in range(n):
+            if active[i] != k:
+                k  = active[i]
+                Vk = V[:k]
+                Vk3 = Vk[:,:,None]
+                sc = scores[:k]
+                bpk = bp[:,:k]
+                emk = emits[:,:k]
+                # -- finished seqs keep their state through the rest of the block --
+                bp[i:,k:] = ident
+            np.add(Vk3, logTrans, out=sc)                       # k x S(prev) x S
+            bpk[i] = sc.argmax(axis=1)
+            np.maximum.reduce(sc, axis=1, out=Vk)
+            Vk += emk[i]
+        blocks.append((blkStart,bp))
+        blkStart = blkEnd
+    
+    # -- trace back, each seq from its own last position (kept by the identity maps) --
+    state = V.argmax(axis=1)
+    stateBlocks = []
+    for blkStart,bp in reversed(blocks):
+        nA = bp.shape[1]
+        F = _composeSuffixes(bp)                                # n x nA x S
+        end = state[:nA]
+        # -- F[i][end] is the state at step blkStart+i-1 --
+        prev = np.take_along_axis(F, np.broadcast_to(end[None,:,None],(len(F),nA,1)).astype(np.intp), axis=-1)[:,:,0]
+        stateBlocks.append((blkStart,np.concatenate((prev[1:],end[None,:]))))
+        state[:nA] = prev[0]
+    stateBlocks.reverse()
+    
+    logProbs = np.empty(B)
+    logProbs[order] = V.max(axis=1)
+    paths = [None]*B
+    for r in range(B):
+        L = -negLens[r]
+        parts = [state[r:r+1]] + [stBlk[:L-blkStart,r] for blkStart,stBlk in stateBlocks
+                                  if r < stBlk.shape[1]]
+        paths[order[r]] = np.concatenate(parts).astype(np.intp)
+    return logProbs,paths
+
+
+
+
+def forwardScaled(obs, start, trans, emit):
+    """Scaled forward pass over integer-encoded <obs> with prob arrays
+    (see hmmToArrays).  Each row of alpha is normalized to sum to 1.
+    Returns (alpha[T,S],scales[T]); log P(obs) == log(scales).sum()."""
+    obs = np.asarray(obs, dtype=np.intp)
+    T = len(obs)
+    emitObs = emit.T[obs]                                     # T x S
+    alpha  = np.empty((T,len(start)))
+    scales = np.empty(T)
+    a = start * emitObs[0]
+    for t in range(T):
+        if t:
+            a = np.dot(a, trans) * emitObs[t]
+        c = a.sum()
+        if not c > 0:
+            raise Exception("**ERROR** obs at position %s is impossible under this model." % (t))
+        a /= c
+        alpha[t]  = a
+        scales[t] = c
+    return alpha,scales
+
+def backwardScaled(obs, trans, emit, scales):
+    """Scaled backward pass matching forwardScaled's <scales>.
+    Returns beta[T,S] such that alpha*beta gives the state posteriors."""
+    obs = np.asarray(obs, dtype=np.intp)
+    T = len(obs)
+    emitObs = emit.T[obs]
+    beta = np.empty((T,trans.shape[0]))
+    b = np.ones(trans.shape[0])
+    beta[-1] = b
+    for t in range(T-2,-1,-1):
+        b = np.dot(trans, emitObs[t+1] * b) / scales[t+1]
+        beta[t] = b
+    return beta
+
+def posteriors(obs, start, trans, emit):
+    """Returns (logLik,gamma[T,S]): per-position state posteriors P(state_t|obs)."""
+    alpha,scales = forwardScaled(obs, start, trans, emit)
+    beta = backwardScaled(obs, trans, emit, scales)
+    return np.log(scales).sum(),alpha*beta
+
+def posteriorDecode(obs, start, trans, emit):
+    """Returns int array of the most probable state at each position."""
+    return posteriors(obs, start, trans, emit)[1].argmax(axis=1)
+
+def _eStep(args):
+    """Expected counts for one obs seq: (logLik,gamma0,transCounts,emitCounts)."""
+    obs,start,trans,emit = args
+    obs = np.asarray(obs, dtype=np.intp)
+    alpha,scales = forwardScaled(obs, start, trans, emit)
+    beta  = backwardScaled(obs, trans, emit, scales)
+    gamma = alpha*beta
+    # -- xi summed over t: alpha[t,i]*trans[i,j]*emit[j,o(t+1)]*beta[t+1,j]/c(t+1) --
+    nxt = emit.T[obs[1:]] * beta[1:] / scales[1:,None]
+    transCounts = np.dot(alpha[:-1].T, nxt) * trans
+    emitCounts  = np.empty(emit.shape)
+    for i in range(emit.shape[0]):
+        emitCounts[i] = np.bincount(obs, weights=gamma[:,i], minlength=emit.shape[1])
+    return np.log(scales).sum(),gamma[0],transCounts,emitCounts
+
+def baumWelch(obsList, start, trans, emit, maxIter=100, tol=1e-6, processes=1):
+    """Re-estimates (start,trans,emit) prob arrays from the integer-encoded
+    seqs in <obsList> (see encodeObs/hmmToArrays).
+    Stops after <maxIter> rounds or when total log-lik improves by < <tol>.
+    With processes > 1 (or None: all cores) the E-step is spread across
+    seqs with a multiprocessing pool.
+    Returns (start,trans,emit,logLikHistory)."""
+    start,trans,emit = [np.array(x, dtype=np.float64) for x in (start,trans,emit)]
+    obsList = [np.asarray(o, dtype=np.intp) for o in obsList if len(o)]
+    pool = None
+    if processes != 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+    history = []
+    try:
+        for it in range(maxIter):
+            jobs = [(o,start,trans,emit) for o in obsList]
+            if pool:
+                results = pool.map(_eStep, jobs)
+            else:
+                results = map(_eStep, jobs)
+            logLik = sum([r[0] for r in results])
+            history.append(logLik)
+            
+            # ++++ M-step: rows with no expected counts keep their old values ++++
+            startNew = sum([r[1] for r in results])
+            start = startNew / startNew.sum()
+            for old,counts in ((trans,sum([r[2] for r in results])),
+                               (emit,sum([r[3] for r in results]))):
+                rowTots = counts.sum(axis=1)
+                seen = rowTots > 0
+                old[seen] = counts[seen] / rowTots[seen,None]
+            
+            if len(history) > 1 and history[-1] - history[-2] < tol:
+                break
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return start,trans,emit,history
+
+
 
 
 if __name__ == "__main__":
@@ -127,5 +1054,6 @@ if __name__ == "__main__":
                        states,
                        start_probability,
                        transition_probability,
-                       emission_probability)
+                       emission_probability,
+                       printTable=True)
     print example()
\ No newline at end of file
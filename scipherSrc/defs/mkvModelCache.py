@@ -0,0 +1,127 @@
+import os
+import glob
+import hashlib
+
+from scipherSrc.defs.seqEncoding import DNA
+from scipherSrc.defs.markovModels import MkvCounts,nOrdMkvCounts,parallelMkvCounts
+
+def hashSeqs(seqIter):
+    """Returns sha1 hex digest of the seqs (or (name,seq) records) in <seqIter>."""
+    h = hashlib.sha1()
+    for seq in seqIter:
+        if isinstance(seq,tuple):
+            seq = seq[1]
+        if hasattr(seq,'fetch'):
+            seq = seq.fetch()
+        h.update(seq)
+        h.update('\0')
+    return h.hexdigest()
+
+def hashFiles(filePaths,blockSize=1024*1024):
+    """Returns sha1 hex digest of the raw bytes of <filePaths>, in order."""
+    h = hashlib.sha1()
+    for path in filePaths:
+        f = open(path, 'rb')
+        while 1:
+            data = f.read(blockSize)
+            if not data:
+                break
+            h.update(data)
+        f.close()
+        h.update('\0')
+    return h.hexdigest()
+
+
+class MkvModelCache(object):
+    """Directory of trained MkvCounts models keyed on (order, alphabet,
+    content hash of the training seqs).  Hits are memory-mapped, so every
+    job training on the same genome shares one model on disk.  When the
+    cache grows past <maxBytes>, least recently used models are removed."""
+    def __init__(self,cacheDir,maxBytes=4*1024**3):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        if not os.path.isdir(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError:
+                if not os.path.isdir(cacheDir):
+                    raise
+
+    def _basePath(self,order,alphabet,sourceHash):
+        key = hashlib.sha1('%s|%s|%s' % (order,'\t'.join(alphabet),sourceHash)).hexdigest()
+        return os.path.join(self.cacheDir, 'mkv_o%s_%s' % (order,key))
+
+    def get(self,order,sourceHash,alphabet=DNA):
+        """Returns the cached MkvCounts or None."""
+        basePath = self._basePath(order,alphabet,sourceHash)
+        if not (os.path.exists(basePath + '.json') and os.path.exists(basePath + '.npy')):
+            return None
+        counts,meta = MkvCounts.load(basePath)
+        # -- mark as recently used for eviction --
+        try:
+            os.utime(basePath + '.npy', None)
+        except OSError:
+            pass
+        return counts
+
+    def put(self,counts,sourceHash):
+        """Saves MkvCounts <counts> under <sourceHash>, then evicts if needed.
+        Empty models (no windows counted) are refused."""
+        if not counts.totalWindows():
+            raise Exception("**ERROR** refusing to cache an empty model (no windows were counted) under %s." % (sourceHash))
+        basePath = self._basePath(counts.order,counts.alphabet,sourceHash)
+        counts.save(basePath,sourceHash=sourceHash)
+        self.evict(keep=basePath)
+
+    def getOrBuild(self,order,seqs,alphabet=DNA,sourceHash=None,processes=1):
+        """Returns cached model for <seqs> or trains, caches and returns it.
+        <seqs> is an iterable of seqs/(name,seq) records; pass <sourceHash>
+        (eg. hashFiles([fastaPath])) to skip hashing the seqs themselves.
+        Without <sourceHash>, one-shot iterators (eg. a ParseFastA) are read
+        into a list first, since they must be walked twice (hash + training).
+        With processes != 1 training uses parallelMkvCounts."""
+        if sourceHash is None:
+            if not isinstance(seqs,(list,tuple)):
+                seqs = list(seqs)
+            sourceHash = hashSeqs(seqs)
+        counts = self.get(order,sourceHash,alphabet)
+        if counts is not None:
+            return counts
+        if processes == 1:
+            counts = nOrdMkvCounts(order,[s[1] if isinstance(s,tuple) else s for s in seqs],alphabet)
+        else:
+            counts = parallelMkvCounts(order,seqs,alphabet,processes=processes)
+        self.put(counts,sourceHash)
+        return counts
+
+    def entries(self):
+        """Returns list of (lastUsed,bytes,basePath) for cached models, oldest first."""
+        entries = []
+        for npy in glob.glob(os.path.join(self.cacheDir, 'mkv_o*.npy')):
+            if '.tmp.' in npy:
+                continue
+            basePath = npy[:-len('.npy')]
+            try:
+                size = os.path.getsize(npy) + os.path.getsize(basePath + '.json')
+                entries.append((os.path.getmtime(npy),size,basePath))
+            except OSError:
+                continue
+        entries.sort()
+        return entries
+
+    def evict(self,keep=None):
+        """Removes least recently used models until the cache fits in
+        maxBytes (the model at basePath <keep> is never removed)."""
+        entries = self.entries()
+        total = sum([e[1] for e in entries])
+        for lastUsed,size,basePath in entries:
+            if total <= self.maxBytes:
+                break
+            if basePath == keep:
+                continue
+            for ext in ('.json','.npy'):
+                try:
+                    os.remove(basePath + ext)
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,218 @@
+import os
+import struct
+
+import numpy as np
+
+from scipherSrc.defs.seqEncoding import DNA,byteLUT
+
+# ++++ UCSC .2bit layout: T,C,A,G == 0,1,2,3; first base in the high bits ++++
+TWOBIT_SIGNATURE = 0x1A412743
+_PACK_ORDER = 'TCAG'
+
+_ASCII2PACK = np.zeros(256, dtype=np.uint8)
+for _i,_b in enumerate(_PACK_ORDER):
+    _ASCII2PACK[ord(_b)] = _i
+    _ASCII2PACK[ord(_b.lower())] = _i
+_IS_ACGT = np.zeros(256, dtype=bool)
+_IS_ACGT[[ord(x) for x in 'ACGTacgt']] = True
+_IS_LOWER = np.zeros(256, dtype=bool)
+_IS_LOWER[ord('a'):ord('z')+1] = True
+
+# -- each packed byte -> its 4 bases as ascii --
+_BYTE2ASCII = np.array([[ord(_PACK_ORDER[(b >> s) & 3]) for s in (6,4,2,0)] for b in range(256)], dtype=np.uint8)
+
+_COMPLEMENT = np.arange(256, dtype=np.uint8)
+for _a,_b in zip('ACGTNacgtn','TGCANtgcan'):
+    _COMPLEMENT[ord(_a)] = ord(_b)
+
+
+def _runs(mask):
+    """Returns (starts,sizes) uint32 arrays of the True runs in bool <mask>."""
+    edges = np.diff(np.concatenate(([0],mask.view(np.int8),[0])))
+    starts = np.flatnonzero(edges == 1)
+    ends   = np.flatnonzero(edges == -1)
+    return starts.astype(np.uint32),(ends - starts).astype(np.uint32)
+
+def _runsIn(starts,sizes,start,end):
+    """Yields (runStart,runEnd) of runs overlapping [start,end), clipped to it."""
+    if not len(starts):
+        return
+    ends = starts.astype(np.int64) + sizes
+    first = np.searchsorted(ends, start, 'right')
+    last  = np.searchsorted(starts, end, 'left')
+    for i in range(first,last):
+        yield max(int(starts[i]),start),min(int(ends[i]),end)
+
+
+class PackedSeq(object):
+    """DNA seq stored at 2 bits per base (UCSC .2bit packing) with side
+    run lists for N (any non-ACGT symbol) and soft-masked (lowercase)
+    regions.  Slicing, iteration and reverseComplement only unpack the
+    bytes covering the requested range."""
+    def __init__(self,packed,length,nStarts,nSizes,maskStarts,maskSizes):
+        """Use PackedSeq.fromStr() or TwoBitFile[...] instead of calling this."""
+        self.packed = packed
+        self.length = length
+        self.nStarts,self.nSizes = nStarts,nSizes
+        self.maskStarts,self.maskSizes = maskStarts,maskSizes
+
+    @classmethod
+    def fromStr(cls,seq):
+        raw = np.frombuffer(seq, dtype=np.uint8)
+        n = len(raw)
+        codes = np.zeros(((n + 3) // 4) * 4, dtype=np.uint8)
+        codes[:n] = _ASCII2PACK[raw]
+        quads = codes.reshape(-1,4)
+        packed = (quads[:,0] << 6) | (quads[:,1] << 4) | (quads[:,2] << 2) | quads[:,3]
+        nStarts,nSizes = _runs(~_IS_ACGT[raw])
+        maskStarts,maskSizes = _runs(_IS_LOWER[raw])
+        return cls(packed.astype(np.uint8),n,nStarts,nSizes,maskStarts,maskSizes)
+
+    def __len__(self):
+        return self.length
+
+    def nbytes(self):
+        """Resident bytes of the packed data and run lists."""
+        return sum([x.nbytes for x in (self.packed,self.nStarts,self.nSizes,self.maskStarts,self.maskSizes)])
+
+    def _range(self,start,end):
+        start,end,step = slice(start,end).indices(self.length)
+        if step != 1:
+            raise Exception("**ERROR** PackedSeq slices must have step 1.")
+        return start,max(start,end)
+
+    def _unpack(self,start,end,table):
+        """Returns per-base rows of <table> for bases [start,end)."""
+        first = start // 4
+        last  = (end + 3) // 4
+        bases = table[self.packed[first:last]].ravel()
+        return bases[start - first*4:end - first*4]
+
+    def asciiArray(self,start=None,end=None):
+        """Returns uint8 ascii array of bases [start,end), with Ns and soft masking."""
+        start,end = self._range(start,end)
+        out = self._unpack(start,end,_BYTE2ASCII)
+        # -- Ns first so soft-masked Ns come out as 'n' --
+        for a,b in _runsIn(self.nStarts,self.nSizes,start,end):
+            out[a-start:b-start] = ord('N')
+        for a,b in _runsIn(self.maskStarts,self.maskSizes,start,end):
+            out[a-start:b-start] |= 0x20
+        return out
+
+    def fetch(self,start=None,end=None):
+        """Returns str of bases [start,end) (0-based, end-exclusive)."""
+        return self.asciiArray(start,end).tostring()
+
+    def __getitem__(self,key):
+        if isinstance(key,slice):
+            if key.step not in (None,1):
+                return self.fetch()[key]
+            return self.fetch(key.start,key.stop)
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("PackedSeq index out of range")
+        return self.fetch(key,key+1)
+
+    def __str__(self):
+        return self.fetch()
+
+    def __iter__(self,chunkSize=65536):
+        for i in xrange(0,self.length,chunkSize):
+            for base in self.fetch(i,i+chunkSize):
+                yield base
+
+    def reverseComplement(self,start=None,end=None):
+        """Returns str reverse complement of bases [start,end)."""
+        return _COMPLEMENT[self.asciiArray(start,end)[::-1]].tostring()
+
+    def dnaCodes(self,start=None,end=None,mask=False):
+        """Returns seqEncoding-style DNA codes (A,C,G,T == 0..3; N == BAD_CODE)
+        for [start,end), ready for seqEncoding.kmerCodes / MkvCounts.
+        Goes through the same table as seqEncoding.encodeSeq, so soft-masked
+        bases are handled alike: same codes as uppercase unless <mask>."""
+        return byteLUT(DNA,mask)[self.asciiArray(start,end)]
+
+
+# ++++ .2bit files ++++
+
+def writeTwoBit(filePath,records):
+    """Writes (name,seq) records (seq a str or PackedSeq) to a UCSC .2bit file."""
+    records = [(name,seq if isinstance(seq,PackedSeq) else PackedSeq.fromStr(seq)) for name,seq in records]
+    header = struct.pack('<IIII', TWOBIT_SIGNATURE, 0, len(records), 0)
+    indexSize = sum([1 + len(name) + 4 for name,seq in records])
+    offset = len(header) + indexSize
+    index  = []
+    blobs  = []
+    for name,seq in records:
+        if len(name) > 255:
+            raise Exception("**ERROR** .2bit seq names are limited to 255 chars: %s" % (name))
+        index.append(struct.pack('<B', len(name)) + name + struct.pack('<I', offset))
+        blob = ''.join([struct.pack('<II', seq.length, len(seq.nStarts)),
+                        seq.nStarts.astype('<u4').tostring(), seq.nSizes.astype('<u4').tostring(),
+                        struct.pack('<I', len(seq.maskStarts)),
+                        seq.maskStarts.astype('<u4').tostring(), seq.maskSizes.astype('<u4').tostring(),
+                        struct.pack('<I', 0),
+                        np.asarray(seq.packed).tostring()])
+        blobs.append(blob)
+        offset += len(blob)
+        if offset >= 2**32:
+            raise Exception("**ERROR** .2bit files (version 0) must be smaller than 4GB.")
+    outFile = open(filePath, 'wb')
+    outFile.write(header)
+    outFile.write(''.join(index))
+    for blob in blobs:
+        outFile.write(blob)
+    outFile.close()
+
+
+class TwoBitFile(object):
+    """Memory-mapped .2bit file; records come back as PackedSeq objects
+    whose packed bytes are views into the map (nothing is read up front)."""
+    def __init__(self,filePath):
+        self._file = open(filePath, 'rb')
+        self._data = np.memmap(self._file, dtype=np.uint8, mode='r')
+        sig,version,count,reserved = struct.unpack('<IIII', self._data[:16].tostring())
+        if sig != TWOBIT_SIGNATURE:
+            raise Exception("**ERROR** %s is not a little-endian .2bit file." % (filePath))
+        self._index = {}
+        self._names = []
+        pos = 16
+        for i in range(count):
+            nameLen = int(self._data[pos])
+            name = self._data[pos+1:pos+1+nameLen].tostring()
+            self._index[name] = struct.unpack('<I', self._data[pos+1+nameLen:pos+5+nameLen].tostring())[0]
+            self._names.append(name)
+            pos += 5 + nameLen
+
+    def keys(self):
+        return list(self._names)
+
+    def __contains__(self,name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._names)
+
+    def _u32(self,pos,n=1):
+        return self._data[pos:pos+4*n].view('<u4')
+
+    def __getitem__(self,name):
+        pos = self._index[name]
+        length,nCount = [int(x) for x in self._u32(pos,2)]
+        pos += 8
+        nStarts,nSizes = self._u32(pos,nCount),self._u32(pos+4*nCount,nCount)
+        pos += 8*nCount
+        mCount = int(self._u32(pos)[0])
+        pos += 4
+        mStarts,mSizes = self._u32(pos,mCount),self._u32(pos+4*mCount,mCount)
+        pos += 8*mCount + 4
+        packed = self._data[pos:pos+(length+3)//4]
+        return PackedSeq(packed,length,nStarts,nSizes,mStarts,mSizes)
+
+    def toDict(self):
+        return dict([(name,self[name]) for name in self._names])
+
+    def close(self):
+        del self._data
+        self._file.close()
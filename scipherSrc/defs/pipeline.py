@@ -0,0 +1,272 @@
+import time
+import Queue
+import threading
+
+_END = object()   # end-of-stream marker passed down the queues
+
+class _Aborted(Exception):
+    pass
+
+
+class StageStats(object):
+    """Per-stage counters: records, batches and busy/wall seconds."""
+    def __init__(self,name):
+        self.name    = name
+        self.items   = 0
+        self.batches = 0
+        self.busy    = 0.0
+        self.started = None
+        self.stopped = None
+
+    def wallTime(self):
+        if self.started is None:
+            return 0.0
+        return (self.stopped or time.time()) - self.started
+
+    def throughput(self):
+        """Records per wall-clock second."""
+        wall = self.wallTime()
+        return self.items / wall if wall else 0.0
+
+    def __str__(self):
+        return '%-20s %12d recs %8d batches %9.2fs busy %9.2fs wall %12.1f recs/s' % \
+               (self.name,self.items,self.batches,self.busy,self.wallTime(),self.throughput())
+
+
+def iterParser(parser):
+    """Returns an iterator over the records of any files_io parser
+    (ParseFastQ/ParseFastA iterate; ParseBowtieMap/ParseSolexaSorted use getNext)."""
+    if not hasattr(parser,'next') and hasattr(parser,'getNext'):
+        return iter(parser.getNext,None)
+    return iter(parser)
+
+def formatFastQ(rec):
+    return '%s\n%s\n%s\n%s\n' % tuple(rec)
+
+def formatFastA(rec):
+    return '>%s\n%s\n' % tuple(rec)
+
+def _applyStage(func,batchFunc,batch):
+    """Runs a stage func over one batch (module level so pools can pickle it)."""
+    if batchFunc:
+        return func(batch)
+    out = []
+    for item in batch:
+        item = func(item)
+        if item is not None:
+            out.append(item)
+    return out
+
+
+class Stage(object):
+    """A transform between source and sink.
+    <func>(record) returns the new record, or None to drop it; with
+    <batchFunc> it gets and returns a whole list of records instead.
+    <processes>: 0 runs the stage in a thread; N > 0 sends batches to a
+    pool of N processes (func must then be a picklable module-level func),
+    keeping at most <maxInFlight> batches outstanding and output in order."""
+    def __init__(self,func,name=None,processes=0,batchFunc=False,maxInFlight=None):
+        self.func = func
+        self.name = name or getattr(func,'__name__','stage')
+        self.processes = processes
+        self.batchFunc = batchFunc
+        self.maxInFlight = maxInFlight or 2*max(processes,1)
+        self.stats = StageStats(self.name)
+
+    def _openPool(self):
+        """Started from the main thread before any stage threads exist."""
+        self._pool = None
+        if self.processes:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(self.processes)
+
+    def _run(self,getBatch,putBatch):
+        if not self.processes:
+            while 1:
+                batch = getBatch()
+                if batch is _END:
+                    break
+                t = time.time()
+                out = _applyStage(self.func,self.batchFunc,batch)
+                self.stats.busy += time.time() - t
+                self._count(out)
+                putBatch(out)
+            return
+        import collections
+        pool = self._pool
+        inFlight = collections.deque()
+        try:
+            while 1:
+                batch = getBatch()
+                if batch is not _END:
+                    inFlight.append(pool.apply_async(_applyStage,(self.func,self.batchFunc,batch)))
+                # -- drain finished batches in order; block once the window is full --
+                while inFlight and (batch is _END or len(inFlight) >= self.maxInFlight or inFlight[0].ready()):
+                    t = time.time()
+                    out = inFlight.popleft().get()
+                    self.stats.busy += time.time() - t
+                    self._count(out)
+                    putBatch(out)
+                if batch is _END:
+                    break
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _count(self,out):
+        self.stats.items += len(out)
+        self.stats.batches += 1
+
+
+class BufferedWriterSink(object):
+    """Sink writing <formatter>(record) strings to <outFile>, flushing in
+    writes of about <bufferSize> chars."""
+    def __init__(self,outFile,formatter=str,bufferSize=1024*1024):
+        self.outFile = outFile
+        self.formatter = formatter
+        self.bufferSize = bufferSize
+        self._parts = []
+        self._size = 0
+
+    def __call__(self,batch):
+        text = ''.join([self.formatter(x) for x in batch])
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self.outFile.write(''.join(self._parts))
+            self._parts = []
+            self._size = 0
+
+    def close(self):
+        self.flush()
+        self.outFile.flush()
+
+
+class Pipeline(object):
+    """Connects a source, a list of Stages and a sink with bounded queues.
+    Each part runs concurrently; a full queue blocks the part feeding it
+    (backpressure), so memory stays bounded.
+    Exmpl:
+        def trim(rec):
+            ...return trimmed rec, or None to drop it...
+        pipe = Pipeline(ParseFastQ('reads.fq.gz'),
+                        [Stage(trim,processes=4)],
+                        BufferedWriterSink(open('trimmed.fq','w'),formatFastQ))
+        pipe.run()
+        print >> sys.stderr, pipe.report()
+
+    <source>: any iterable of records or a files_io parser.
+    <sink>: callable given each output batch (list), eg. a BufferedWriterSink;
+    its close() is called at the end if it has one.
+    <batchSize> records travel together; each queue holds <queueSize> batches."""
+    def __init__(self,source,stages=(),sink=None,batchSize=1000,queueSize=8):
+        self.source = source
+        self.stages = list(stages)
+        self.sink   = sink
+        self.batchSize = batchSize
+        self.queueSize = queueSize
+        self.sourceStats = StageStats('source')
+        self.sinkStats   = StageStats('sink')
+        self._abort  = threading.Event()
+        self._errors = []
+
+    def _put(self,q,item):
+        while 1:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                if self._abort.is_set():
+                    raise _Aborted()
+
+    def _get(self,q):
+        while 1:
+            try:
+                return q.get(timeout=0.1)
+            except Queue.Empty:
+                if self._abort.is_set():
+                    raise _Aborted()
+
+    def _runSource(self,outQ):
+        records = iterParser(self.source)
+        stats = self.sourceStats
+        while 1:
+            t = time.time()
+            batch = []
+            for rec in records:
+                if rec is not None:
+                    batch.append(rec)
+                    if len(batch) >= self.batchSize:
+                        break
+            stats.busy += time.time() - t
+            if not batch:
+                break
+            stats.items += len(batch)
+            stats.batches += 1
+            self._put(outQ,batch)
+        self._put(outQ,_END)
+
+    def _runStage(self,stage,inQ,outQ):
+        stage._run(lambda: self._get(inQ), lambda batch: self._put(outQ,batch))
+        self._put(outQ,_END)
+
+    def _guard(self,target,stats,*args):
+        """Thread body: runs target, records errors and stops the other stages."""
+        stats.started = time.time()
+        try:
+            target(*args)
+        except _Aborted:
+            pass
+        except Exception, e:
+            import traceback
+            self._errors.append((stats.name,e,traceback.format_exc()))
+            self._abort.set()
+        stats.stopped = time.time()
+
+    def run(self):
+        """Runs the pipeline to completion in the calling thread (which
+        drives the sink).  Returns list of StageStats."""
+        queues = [Queue.Queue(self.queueSize) for i in range(len(self.stages)+1)]
+        for stage in self.stages:
+            stage._openPool()
+        threads = [threading.Thread(target=self._guard, args=(self._runSource,self.sourceStats,queues[0]))]
+        for i,stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._guard,
+                                            args=(self._runStage,stage.stats,stage,queues[i],queues[i+1])))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self._guard(self._drain,self.sinkStats,queues[-1])
+        for t in threads:
+            t.join()
+        if self._errors:
+            name,e,tb = self._errors[0]
+            raise Exception("**ERROR** pipeline stage '%s' failed:\n%s" % (name,tb))
+        return self.stats()
+
+    def _drain(self,inQ):
+        stats = self.sinkStats
+        while 1:
+            batch = self._get(inQ)
+            if batch is _END:
+                break
+            t = time.time()
+            if self.sink is not None:
+                self.sink(batch)
+            stats.busy += time.time() - t
+            stats.items += len(batch)
+            stats.batches += 1
+        if hasattr(self.sink,'close'):
+            self.sink.close()
+
+    def stats(self):
+        return [self.sourceStats] + [s.stats for s in self.stages] + [self.sinkStats]
+
+    def report(self):
+        """Returns one line of counters per stage."""
+        return '\n'.join([str(s) for s in self.stats()])
@@ -0,0 +1,81 @@
+import numpy as np
+
+DNA = 'ACGT'
+BAD_CODE = 255  # code given to symbols that are not in the alphabet
+
+def _byteLUT(alphabet,mask=False):
+    """Returns 256-long uint8 lookup table mapping byte values to alphabet codes.
+    For DNA, lowercase acgt share the codes of ACGT unless <mask>."""
+    lut = np.empty(256, dtype=np.uint8)
+    lut.fill(BAD_CODE)
+    for i,sym in enumerate(alphabet):
+        lut[ord(sym)] = i
+        if list(alphabet) == list(DNA) and not mask:
+            lut[ord(sym.lower())] = i
+    return lut
+
+_lutCache = {}
+
+def byteLUT(alphabet=DNA,mask=False):
+    """Returns the (cached, shared) byte -> code lookup table used by
+    encodeSeq for an <alphabet> of single chars.  Index it with a uint8
+    array of ascii bytes.  See encodeSeq for <mask>."""
+    key = (tuple(alphabet),bool(mask))
+    try:
+        return _lutCache[key]
+    except KeyError:
+        lut = _lutCache[key] = _byteLUT(alphabet,mask)
+        return lut
+
+def encodeSeq(seq,alphabet=DNA,mask=False):
+    """Returns uint8 array of alphabet codes for <seq>.
+    With DNA, A,C,G,T -> 0,1,2,3 (2-bit values) and soft-masked (lowercase)
+    a,c,g,t get the same codes, unless <mask> is True: then lowercase
+    bases get BAD_CODE, so kmer windows touching them are skipped.
+    Symbols not in <alphabet> get BAD_CODE.
+
+    If every symbol in <alphabet> is a single character and <seq> is a str,
+    the encoding is a single table lookup over the raw bytes.  Otherwise
+    (eg. alphabet of words, seq a list of tokens) each symbol is mapped
+    through a dict."""
+    if len(alphabet) > BAD_CODE:
+        raise Exception("**ERROR** alphabet can hold at most %s symbols." % (BAD_CODE))
+    if isinstance(seq,str) and all([len(x) == 1 for x in alphabet]):
+        return byteLUT(alphabet,mask)[np.frombuffer(seq, dtype=np.uint8)]
+    symCodes = dict([(sym,i) for i,sym in enumerate(alphabet)])
+    if list(alphabet) == list(DNA) and not mask:
+        symCodes.update([(sym.lower(),i) for i,sym in enumerate(alphabet)])
+    return np.array([symCodes.get(x,BAD_CODE) for x in seq], dtype=np.uint8)
+
+def decodeSeq(codes,alphabet=DNA):
+    """Returns str (or list if alphabet symbols are not single chars) for <codes>."""
+    if all([len(x) == 1 for x in alphabet]):
+        return ''.join([alphabet[c] for c in codes])
+    return [alphabet[c] for c in codes]
+
+def kmerCodes(codes,k,base=4):
+    """Returns (kmers,valid): int64 array with one integer code for each of the
+    len(codes)-k+1 windows of length <k> in <codes>, and a bool array that is
+    False for windows containing a BAD_CODE symbol.
+    Codes are built with rolling arithmetic: code = code*base + nextSym
+    (a 2-bit shift when base==4), one vectorized pass per window position."""
+    codes = np.asarray(codes)
+    nWin  = len(codes) - k + 1
+    if nWin <= 0:
+        return np.zeros(0, dtype=np.int64),np.zeros(0, dtype=bool)
+    if float(base)**k >= 2**63:
+        raise Exception("**ERROR** base**k is too large to hold in an int64 kmer code.")
+
+    kmers = np.zeros(nWin, dtype=np.int64)
+    for j in range(k):
+        col = codes[j:j+nWin].astype(np.int64)
+        if base == 4:
+            kmers <<= 2
+            kmers |= col & 3
+        else:
+            kmers *= base
+            kmers += col
+    # -- windows touching a bad symbol are flagged by a running count of bad symbols --
+    bad = np.concatenate(([0], np.cumsum(codes == BAD_CODE)))
+    valid = (bad[k:] - bad[:nWin]) == 0
+    return kmers,valid
@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+
+_DNA_BYTES = np.frombuffer('ACGTN', dtype=np.uint8)
+
+def randomSeqs(rng,lengths,gc=0.5,nRate=0.0):
+    """Returns list of random DNA strs with the given <lengths>, drawn from
+    numpy RandomState <rng>.  <gc>: G+C fraction; <nRate>: fraction of Ns."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    at,cg = (1.0-gc)/2,gc/2
+    probs = np.array([at,cg,cg,at,0.0])*(1.0-nRate)
+    probs[4] = nRate
+    codes = np.searchsorted(np.cumsum(probs), rng.random_sample(total), 'right')
+    raw = _DNA_BYTES[np.minimum(codes,4)].tostring()
+    ends = np.cumsum(lengths)
+    return [raw[e-l:e] for e,l in zip(ends,lengths)]
+
+def _randomQuals(rng,lengths,offset=33):
+    """Returns list of Phred quality strs: scores fall off toward the 3' end
+    like a real run, with noise."""
+    out = []
+    total = int(np.sum(lengths))
+    noise = rng.randint(-6, 5, size=total)
+    pos = 0
+    for L in lengths:
+        ramp = 38 - (np.arange(L)*20)//max(L,1)
+        q = np.clip(ramp + noise[pos:pos+L], 2, 41) + offset
+        out.append(q.astype(np.uint8).tostring())
+        pos += L
+    return out
+
+def _writeChunks(filePath,recIter):
+    """Writes strs from <recIter> to <filePath>; returns bytes written."""
+    outFile = open(filePath, 'wb')
+    for text in recIter:
+        outFile.write(text)
+    outFile.close()
+    return os.path.getsize(filePath)
+
+def _chunkSizes(n,chunk=50000):
+    while n > 0:
+        yield min(n,chunk)
+        n -= chunk
+
+def writeFastQ(filePath,nReads,readLen=(36,101),seed=0,offset=33,nRate=0.005):
+    """Writes <nReads> random fastQ reads with lengths in [readLen[0],readLen[1]).
+    Returns bytes written.  The same <seed> always gives the same file."""
+    rng = np.random.RandomState(seed)
+    def chunks():
+        readNum = 0
+        for n in _chunkSizes(nReads):
+            lengths = rng.randint(readLen[0], readLen[1], size=n)
+            seqs  = randomSeqs(rng,lengths,nRate=nRate)
+            quals = _randomQuals(rng,lengths,offset)
+            lines = []
+            for seq,qual in zip(seqs,quals):
+                lines.append('@SYN:1:%s:%s#0/1\n%s\n+\n%s\n' % (readNum // 10000,readNum,seq,qual))
+                readNum += 1
+            yield ''.join(lines)
+    return _writeChunks(filePath,chunks())
+
+def writeFastA(filePath,nRecs,seqLen=(200,5000),seed=0,lineWidth=60,gc=0.45):
+    """Writes <nRecs> random fastA records wrapped at <lineWidth>.
+    Returns bytes written."""
+    rng = np.random.RandomState(seed)
+    def chunks():
+        recNum = 0
+        for n in _chunkSizes(nRecs,1000):
+            lengths = rng.randint(seqLen[0], seqLen[1], size=n)
+            lines = []
+            for seq in randomSeqs(rng,lengths,gc=gc):
+                lines.append('>seq%s synthetic len=%s\n' % (recNum,len(seq)))
+                for i in xrange(0,len(seq),lineWidth):
+                    lines.append(seq[i:i+lineWidth] + '\n')
+                recNum += 1
+            yield ''.join(lines)
+    return _writeChunks(filePath,chunks())
+
+def _contigs(nContigs,contigLen):
+    return ['chr%s' % (i+1) for i in range(nContigs)],contigLen
+
+def writeBowtieMap(filePath,nReads,nContigs=5,contigLen=10**7,readLen=(25,40),seed=0):
+    """Writes <nReads> bowtie.map lines (ParseBowtieMap format).
+    Returns bytes written."""
+    rng = np.random.RandomState(seed)
+    names,contigLen = _contigs(nContigs,contigLen)
+    def chunks():
+        readNum = 0
+        for n in _chunkSizes(nReads):
+            lengths = rng.randint(readLen[0], readLen[1], size=n)
+            ctgs    = rng.randint(0, nContigs, size=n)
+            starts  = rng.randint(0, contigLen, size=n)
+            strands = rng.randint(0, 2, size=n)
+            seqs    = randomSeqs(rng,lengths)
+            lines = []
+            for i,seq in enumerate(seqs):
+                lines.append('r%s\t%s\t%s\t%s\t%s\t%s\t0\t\n' % (readNum,'+-'[strands[i]],names[ctgs[i]],
+                                                               starts[i],seq,'I'*len(seq)))
+                readNum += 1
+            yield ''.join(lines)
+    return _writeChunks(filePath,chunks())
+
+def writeSolexaSorted(filePath,nReads,nContigs=5,contigLen=10**7,readLen=(25,40),seed=0):
+    """Writes <nReads> solexa x_sorted.txt lines (ParseSolexaSorted format),
+    sorted by contig and start.  Returns bytes written."""
+    rng = np.random.RandomState(seed)
+    names,contigLen = _contigs(nContigs,contigLen)
+    lengths = rng.randint(readLen[0], readLen[1], size=nReads)
+    ctgs    = rng.randint(0, nContigs, size=nReads)
+    starts  = rng.randint(0, contigLen, size=nReads)
+    strands = rng.randint(0, 2, size=nReads)
+    order   = np.lexsort((starts,ctgs))
+    seqs    = randomSeqs(rng,lengths)
+    def chunks():
+        for lo in xrange(0,nReads,50000):
+            lines = []
+            for i in order[lo:lo+50000]:
+                lines.append('SYN\t1\t1\t%s\t%s\t%s\t0\t1\t%s\t%s\t0\t%s\t%s\t%s\t%s\n' %
+                             (i // 10000,i % 10000,i,seqs[i],'h'*lengths[i],names[ctgs[i]],
+                              starts[i],'FR'[strands[i]],lengths[i]))
+            yield ''.join(lines)
+    return _writeChunks(filePath,chunks())
+
+def writeAnnotationTable(filePath,nFeatures,blocks=(1,12),nContigs=5,contigLen=10**7,seed=0,sep='\t'):
+    """Writes a block-per-row feature table (namedTable2BED input: columns
+    transcript_name, name, seq_region_start, seq_region_end, strand) with
+    1-based closed block coords.  Returns bytes written."""
+    rng = np.random.RandomState(seed)
+    names,contigLen = _contigs(nContigs,contigLen)
+    def chunks():
+        yield sep.join(['transcript_name','name','seq_region_start','seq_region_end','strand']) + '\n'
+        featNum = 0
+        for n in _chunkSizes(nFeatures,10000):
+            nBlocks = rng.randint(blocks[0], blocks[1], size=n)
+            ctgs    = rng.randint(0, nContigs, size=n)
+            starts  = rng.randint(1, contigLen, size=n)
+            strands = rng.randint(0, 2, size=n)
+            lines = []
+            for i in range(n):
+                pos = starts[i]
+                sizes = rng.randint(50, 400, size=nBlocks[i])
+                gaps  = rng.randint(100, 5000, size=nBlocks[i])
+                for size,gap in zip(sizes,gaps):
+                    lines.append(sep.join(['t%s' % (featNum),names[ctgs[i]],str(pos),
+                                           str(pos+size-1),('1','-1')[strands[i]]]) + '\n')
+                    pos += size + gap
+                featNum += 1
+            yield ''.join(lines)
+    return _writeChunks(filePath,chunks())
@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import gzip
+import shutil
+import platform
+import optparse
+import resource
+import tempfile
+
+import numpy as np
+
+from scipherSrc.defs import synthData
+from scipherSrc.defs.instrument import peakRssMB
+from scipherSrc.defs.files_io import ParseFastQ,ParseFastA,ParseBowtieMap,ParseSolexaSorted,tableFile2namedTuple
+from scipherSrc.defs.markovModels import nOrdMkvBkg,nOrdMkvCounts,MkvScorer,viterbi
+
+# +++++ Synthetic inputs: name -> (fileName,writerFunc,kwargs at scale 1) +++++
+DATASETS = {'fastq'    :('reads.fq',   synthData.writeFastQ,          {'nReads':200000}),
+            'fasta'    :('seqs.fa',    synthData.writeFastA,          {'nRecs':5000}),
+            'bowtieMap':('reads.map',  synthData.writeBowtieMap,      {'nReads':200000}),
+            'solexa'   :('sorted.txt', synthData.writeSolexaSorted,   {'nReads':200000}),
+            'table'    :('feats.tsv',  synthData.writeAnnotationTable,{'nFeatures':20000}),
+            }
+
+def makeData(dataDir,scale=1.0,seed=0):
+    """Writes every DATASET (sizes times <scale>) to <dataDir> unless already
+    there, plus a gzipped copy of the fastQ.  Returns {name:path}."""
+    if not os.path.isdir(dataDir):
+        os.makedirs(dataDir)
+    paths = {}
+    for name,(fileName,writer,kwargs) in sorted(DATASETS.items()):
+        root,ext = os.path.splitext(fileName)
+        path = os.path.join(dataDir,'%s.s%s%s' % (root,scale,ext))
+        if not os.path.exists(path):
+            sized = dict([(k,max(int(v*scale),1)) for k,v in kwargs.items()])
+            writer(path + '.tmp',seed=seed,**sized)
+            os.rename(path + '.tmp',path)
+        paths[name] = path
+    paths['fastqGz'] = paths['fastq'] + '.gz'
+    if not os.path.exists(paths['fastqGz']):
+        inFile = open(paths['fastq'],'rb')
+        outFile = gzip.GzipFile(paths['fastqGz'] + '.tmp','wb',6,mtime=0)
+        shutil.copyfileobj(inFile,outFile)
+        outFile.close()
+        inFile.close()
+        os.rename(paths['fastqGz'] + '.tmp',paths['fastqGz'])
+    return paths
+
+
+# +++++ Benchmarks: func(paths) -> (records,bytesRead) +++++
+
+def _countIter(it):
+    n = 0
+    for rec in it:
+        n += 1
+    return n
+
+def _countGetNext(parser):
+    n = 0
+    while parser.getNext():
+        n += 1
+    return n
+
+def benchParseFastQ(paths):
+    return _countIter(ParseFastQ(paths['fastq'])),os.path.getsize(paths['fastq'])
+
+def benchParseFastQGz(paths):
+    # -- bytes are the decompressed size, so MB/s compares with the plain run --
+    return _countIter(ParseFastQ(paths['fastqGz'])),os.path.getsize(paths['fastq'])
+
+def benchParseFastA(paths):
+    return _countIter(ParseFastA(paths['fasta'])),os.path.getsize(paths['fasta'])
+
+def benchFastAToDict(paths):
+    return len(ParseFastA(paths['fasta']).toDict()),os.path.getsize(paths['fasta'])
+
+def benchBowtieMap(paths):
+    return _countGetNext(ParseBowtieMap(paths['bowtieMap'])),os.path.getsize(paths['bowtieMap'])
+
+def benchSolexaSorted(paths):
+    return _countGetNext(ParseSolexaSorted(paths['solexa'])),os.path.getsize(paths['solexa'])
+
+def benchTableNamedTuple(paths):
+    return len(tableFile2namedTuple(paths['table'])),os.path.getsize(paths['table'])
+
+def _fastaSeqs(paths):
+    return [rec[1] for rec in ParseFastA(paths['fasta'])]
+
+def benchMkvBkgDict(paths):
+    """Records are bases."""
+    seqs = _fastaSeqs(paths)[:200]
+    nOrdMkvBkg(3,seqs)
+    return sum([len(x) for x in seqs]),0
+
+def benchMkvBkgArray(paths):
+    seqs = _fastaSeqs(paths)
+    nOrdMkvBkg(3,seqs,'ACGT')
+    return sum([len(x) for x in seqs]),0
+
+def benchMkvScorer(paths):
+    seqs = _fastaSeqs(paths)
+    MkvScorer(nOrdMkvCounts(5,seqs)).scoreBatch(seqs)
+    return sum([len(x) for x in seqs]),0
+
+_HMM_STATES = ('Rainy','Sunny')
+_HMM_START  = {'Rainy':0.6,'Sunny':0.4}
+_HMM_TRANS  = {'Rainy':{'Rainy':0.7,'Sunny':0.3},
+               'Sunny':{'Rainy':0.4,'Sunny':0.6}}
+_HMM_EMIT   = {'Rainy':{'walk':0.1,'shop':0.4,'clean':0.5},
+               'Sunny':{'walk':0.6,'shop':0.3,'clean':0.1}}
+
+def benchViterbi(paths):
+    """Records are observations (2000 chains of 200)."""
+    rng = np.random.RandomState(0)
+    symbols = ['walk','shop','clean']
+    n = 0
+    for i in range(2000):
+        obs = [symbols[x] for x in rng.randint(0,3,size=200)]
+        viterbi(obs,_HMM_STATES,_HMM_START,_HMM_TRANS,_HMM_EMIT)
+        n += len(obs)
+    return n,0
+
+BENCHMARKS = [('ParseFastQ',        benchParseFastQ),
+              ('ParseFastQ.gz',     benchParseFastQGz),
+              ('ParseFastA',        benchParseFastA),
+              ('ParseFastA.toDict', benchFastAToDict),
+              ('ParseBowtieMap',    benchBowtieMap),
+              ('ParseSolexaSorted', benchSolexaSorted),
+              ('tableFile2namedTuple',benchTableNamedTuple),
+              ('nOrdMkvBkg.dict',   benchMkvBkgDict),
+              ('nOrdMkvBkg.array',  benchMkvBkgArray),
+              ('MkvScorer.batch',   benchMkvScorer),
+              ('viterbi',           benchViterbi),
+              ]
+
+
+# +++++ Measuring +++++
+
+def _currentRssMB():
+    try:
+        return int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize() / 1048576.0
+    except IOError:
+        return 0.0
+
+def _measure(args):
+    """Pool worker (fresh process per benchmark so peak RSS is its own)."""
+    name,paths,repeat = args
+    func = dict(BENCHMARKS)[name]
+    startRss = _currentRssMB()
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        records,nBytes = func(paths)
+        secs = time.time() - t
+        if best is None or secs < best:
+            best = secs
+    best = max(best,1e-9)
+    return {'seconds':best,
+            'records':records,
+            'bytes':nBytes,
+            'recsPerSec':records/best,
+            'mbPerSec':nBytes/1048576.0/best,
+            'peakRssMB':peakRssMB(),
+            'rssGrowthMB':max(peakRssMB() - startRss,0.0)}
+
+def runBenchmarks(paths,names=None,repeat=3,log=None):
+    """Runs each named benchmark (default: all) in its own process, keeping
+    the best of <repeat> timings.  Returns {name:resultDict}."""
+    import multiprocessing
+    results = {}
+    for name,func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        pool = multiprocessing.Pool(1)
+        try:
+            results[name] = pool.apply(_measure,((name,paths,repeat),))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        if log:
+            print >> log, formatResult(name,results[name])
+    return results
+
+def formatResult(name,r):
+    return '%-22s %12.1f recs/s %9.2f MB/s %9.1f MB peak %9.3fs' % \
+           (name,r['recsPerSec'],r['mbPerSec'],r['peakRssMB'],r['seconds'])
+
+def environment(scale):
+    return {'python':platform.python_version(),
+            'numpy':np.__version__,
+            'platform':platform.platform(),
+            'scale':scale,
+            'date':time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def compareResults(baseline,current,tolerance=0.10):
+    """Returns (lines,regressed): a report of current vs <baseline> recs/s
+    and peak RSS for every benchmark in both, and True if any ran more
+    than <tolerance> slower or used more than <tolerance> more memory."""
+    lines = ['%-22s %14s %14s %8s %10s' % ('benchmark','base recs/s','recs/s','speed','peak RSS')]
+    regressed = False
+    for name,func in BENCHMARKS:
+        if name not in baseline['results'] or name not in current['results']:
+            continue
+        b,c = baseline['results'][name],current['results'][name]
+        speed = c['recsPerSec'] / max(b['recsPerSec'],1e-9)
+        mem   = c['peakRssMB'] / max(b['peakRssMB'],1e-9)
+        flag  = ''
+        if speed < 1 - tolerance or mem > 1 + tolerance:
+            flag = '  <-- REGRESSION'
+            regressed = True
+        lines.append('%-22s %14.1f %14.1f %7.2fx %9.2fx%s' % (name,b['recsPerSec'],c['recsPerSec'],speed,mem,flag))
+    if baseline['env'].get('scale') != current['env'].get('scale'):
+        lines.append('WARNING: baseline scale %s != current scale %s.' % (baseline['env'].get('scale'),current['env'].get('scale')))
+    return lines,regressed
+
+
+def main():
+    usage = """python %prog [options] run
+       python %prog [options] compare baseline.json [current.json]
+       python %prog [options] gen
+
+    run:     runs the benchmarks and writes results (--out) as JSON.
+    compare: compares current.json (or a fresh run) with baseline.json;
+             exits 1 if anything regressed by more than --tolerance.
+    gen:     only writes the synthetic input files."""
+    parser = optparse.OptionParser(usage)
+    parser.add_option('--scale',dest="scale",type="float", default=1.0,
+                      help="""Multiplier for the size of every synthetic input. (default=%default)""")
+    parser.add_option('--data-dir',dest="dataDir",type="str", default=None,
+                      help="""Where synthetic inputs are written and reused. (default=<tmpdir>/scipherBench)""")
+    parser.add_option('--out',dest="out",type="str", default=None,
+                      help="""Path for the results JSON. (default=%default)""")
+    parser.add_option('--only',dest="only",type="str", action="append", default=None,
+                      help="""Run only this benchmark; repeat for more. Choices: %s""" % (', '.join([x[0] for x in BENCHMARKS])))
+    parser.add_option('--repeat',dest="repeat",type="int", default=3,
+                      help="""Timed runs per benchmark; the best is kept. (default=%default)""")
+    parser.add_option('--tolerance',dest="tolerance",type="float", default=0.10,
+                      help="""Allowed fractional slowdown/memory growth in compare. (default=%default)""")
+    parser.add_option('--seed',dest="seed",type="int", default=0,
+                      help="""Random seed for the synthetic inputs. (default=%default)""")
+
+    (opts, args) = parser.parse_args()
+
+    if not args or args[0] not in ('run','compare','gen'):
+        parser.print_help()
+        exit(0)
+    if opts.dataDir is None:
+        opts.dataDir = os.path.join(tempfile.gettempdir(),'scipherBench')
+
+    print >> sys.stderr, 'Writing/reusing synthetic data in %s' % (opts.dataDir)
+    paths = makeData(opts.dataDir,opts.scale,opts.seed)
+    if args[0] == 'gen':
+        for name,path in sorted(paths.items()):
+            print '%s\t%s' % (name,path)
+        return
+
+    if args[0] == 'compare':
+        if len(args) < 2:
+            raise Exception("**ERROR: compare needs a baseline.json.**")
+        baseline = json.load(open(args[1]))
+    if args[0] == 'compare' and len(args) > 2:
+        current = json.load(open(args[2]))
+    else:
+        current = {'env':environment(opts.scale),
+                   'results':runBenchmarks(paths,opts.only,opts.repeat,log=sys.stderr)}
+    if opts.out:
+        outFile = open(opts.out,'w')
+        json.dump(current,outFile,indent=1,sort_keys=True)
+        outFile.close()
+
+    if args[0] == 'compare':
+        lines,regressed = compareResults(baseline,current,opts.tolerance)
+        print '\n'.join(lines)
+        if regressed:
+            exit(1)
+
+if __name__ == "__main__":
+    main()
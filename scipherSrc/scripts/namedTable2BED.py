@@ -1,6 +1,14 @@
+import os
+import csv
 import sys
+import time
 import optparse
-from scipherSrc.defs.files_io import tableFile2namedTuple
+import itertools
+import collections
+from scipherSrc.defs.files_io import tableFile2namedTuple,externalSortTable
+from scipherSrc.defs.fileChunks import RangeFile
+from scipherSrc.defs.compressedIO import sniffCompression
+from scipherSrc.defs.instrument import Instrumented,InstrumentedWriter,stageReport,maybeProfile
 
 strandReps = {'+':'+',
               '-':'-',
@@ -19,11 +27,187 @@ def groupFeatureAlignments(features,opts):
             featureDict[k].append(row)
     return featureDict
 
+def iterSortedFeatureGroups(features,opts):
+    """Yields lists of rows sharing (EST_ID,ChrmID) from <features> that are
+    already sorted/grouped by feature.  Only one feature is held at a time."""
+    def key(row):
+        return (row.__getattribute__(opts.featName),row.__getattribute__(opts.chrm))
+    for k,rows in itertools.groupby(features,key):
+        yield list(rows)
 
+def writeBEDlines(featureGroups,opts,outFile,batchSize=10000):
+    """Formats each group of rows in <featureGroups> as a BED line and writes
+    them to <outFile> in batches of <batchSize> lines."""
+    batch = []
+    for rows in featureGroups:
+        line = formatBEDline(rows,opts)
+        if line is None:
+            continue
+        batch.append(line)
+        if len(batch) >= batchSize:
+            outFile.write('\n'.join(batch) + '\n')
+            batch = []
+    if batch:
+        outFile.write('\n'.join(batch) + '\n')
+
+# +++++ --jobs worker state: set once per worker process by _initBEDworker +++++
+_workerOpts  = None
+_workerTable = None
+
+def _initBEDworker(opts,fields):
+    global _workerOpts,_workerTable
+    _workerOpts  = opts
+    _workerTable = collections.namedtuple('Table', ', '.join(fields))
+
+def _formatBEDchunk(chunk):
+    """Pool worker: returns the BED lines for a chunk of feature groups
+    (rows arrive as plain tuples since the Table class can not be pickled)."""
+    lines = []
+    for rows in chunk:
+        line = formatBEDline([_workerTable._make(row) for row in rows],_workerOpts)
+        if line is not None:
+            lines.append(line)
+    return lines
+
+def _chunkFeatureGroups(featureGroups,chunkFeatures):
+    chunk = []
+    for rows in featureGroups:
+        chunk.append([tuple(row) for row in rows])
+        if len(chunk) >= chunkFeatures:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def writeBEDlinesParallel(featureGroups,opts,outFile,jobs,chunkFeatures=2000):
+    """As writeBEDlines, but chunks of <chunkFeatures> groups are formatted in
+    a pool of <jobs> processes.  Chunks are written back in input order, so
+    the output is identical to the serial path.
+    The rows are still parsed, grouped and pickled to the workers by this
+    process, which caps the speedup well below <jobs>; use
+    writeBEDrangesParallel for grouped (--sorted) plain-text tables."""
+    import multiprocessing
+    featureGroups = iter(featureGroups)
+    try:
+        first = featureGroups.next()
+    except StopIteration:
+        return
+    featureGroups = itertools.chain([first],featureGroups)
+    
+    pool = multiprocessing.Pool(jobs,_initBEDworker,(opts,first[0]._fields))
+    try:
+        for lines in pool.imap(_formatBEDchunk,_chunkFeatureGroups(featureGroups,chunkFeatures)):
+            if lines:
+                outFile.write('\n'.join(lines) + '\n')
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _featureKey(line,sep,keyCols):
+    fields = csv.reader([line], delimiter=sep).next()
+    if not fields:
+        return None
+    return tuple([fields[i] for i in keyCols])
+
+def featureChunkBounds(tablePath,nChunks,opts):
+    """Returns (headers,[(start,end),...]): up to <nChunks> byte ranges of the
+    rows of a plain-text table whose rows are grouped by (featName,chrm).
+    Each range begins where the feature changes, so no feature is split
+    between ranges.  (Rows must not hold quoted newlines.)"""
+    size = os.path.getsize(tablePath)
+    f = open(tablePath, 'rb')
+    headers = csv.reader([f.readline()], delimiter=opts.sep).next()
+    keyCols = [headers.index(opts.featName),headers.index(opts.chrm)]
+    starts  = [f.tell()]
+    for i in range(1,nChunks):
+        offset = starts[0] + ((size - starts[0])*i)//nChunks
+        if offset <= starts[-1]:
+            continue
+        f.seek(offset - 1)
+        if f.read(1) != '\n':
+            f.readline()   # -- skip the partial line --
+        pos  = f.tell()
+        line = f.readline()
+        key  = _featureKey(line,opts.sep,keyCols)
+        while line and _featureKey(line,opts.sep,keyCols) == key:
+            pos += len(line)
+            line = f.readline()
+        if pos >= size:
+            break
+        if pos > starts[-1]:
+            starts.append(pos)
+    f.close()
+    return headers,zip(starts,starts[1:] + [size])
+
+# -- set once per worker process by _initBEDrangeWorker --
+_workerHeaders = None
+
+def _initBEDrangeWorker(opts,headers):
+    global _workerOpts,_workerHeaders
+    _workerOpts    = opts
+    _workerHeaders = headers
+
+def _formatBEDrange(bounds):
+    """Pool worker: parses, groups and formats the rows in one byte range.
+    Returns t(rowsRead,textOfBEDlines)."""
+    tablePath,start,end = bounds
+    opts = _workerOpts
+    # -- ranges are ~chunkBytes, so read whole: file.readline(size) is slow --
+    rangeFile = RangeFile(tablePath,start,end)
+    text = rangeFile.read()
+    rangeFile.close()
+    rows = tableFile2namedTuple(iter(text.splitlines(True)),sep=opts.sep,lazy=True,headers=_workerHeaders,
+                                types={opts.blkChmStrt:int,opts.blkChmEnd:int})
+    nRows = 0
+    lines = []
+    for group in iterSortedFeatureGroups(rows,opts):
+        nRows += len(group)
+        line = formatBEDline(group,opts)
+        if line is not None:
+            lines.append(line)
+    if lines:
+        return nRows,'\n'.join(lines) + '\n'
+    return nRows,''
+
+def writeBEDrangesParallel(tablePath,opts,outFile,jobs,chunkBytes=16*1024*1024):
+    """Writes the BED lines of a plain-text table already grouped by feature
+    (as for --sorted).  The table is cut into byte ranges on feature
+    boundaries (featureChunkBounds) of ~<chunkBytes> (at least 4 per job),
+    and each of <jobs> worker processes reads, parses, groups and formats
+    its own ranges, so this process only writes.  Output is identical to
+    the serial --sorted path.  Returns number of rows read."""
+    import multiprocessing
+    nChunks = max(jobs*4, os.path.getsize(tablePath)//chunkBytes + 1)
+    headers,bounds = featureChunkBounds(tablePath,nChunks,opts)
+    pool = multiprocessing.Pool(jobs,_initBEDrangeWorker,(opts,headers))
+    nRows = 0
+    try:
+        for rowsRead,text in pool.imap(_formatBEDrange,[(tablePath,start,end) for start,end in bounds]):
+            nRows += rowsRead
+            if text:
+                outFile.write(text)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return nRows
 
 def printBEDline(listOfRowsByFeature,opts):
     """Takes a list of block info rows grouped by a single feature.
     Prints the BED line calculated from this information."""
+    line = formatBEDline(listOfRowsByFeature,opts)
+    if line is not None:
+        print line
+
+def formatBEDline(listOfRowsByFeature,opts):
+    """Takes a list of block info rows grouped by a single feature.
+    Returns the BED line calculated from this information (None if the
+    feature is skipped)."""
     
     # +++++ func specific Defs +++++
     def getBlockSizes(feat):
@@ -104,7 +288,7 @@ def printBEDline(listOfRowsByFeature,opts):
     # +++ Gather the required pieces +++    
     chrm      = listOfRowsByFeature[0].__getattribute__(opts.chrm)
     chrmStart = str(int(listOfRowsByFeature[0].__getattribute__(opts.blkChmStrt))-1)
-    chrmEnd   = listOfRowsByFeature[-1].__getattribute__(opts.blkChmEnd)
+    chrmEnd   = str(listOfRowsByFeature[-1].__getattribute__(opts.blkChmEnd))
     name      = listOfRowsByFeature[0].__getattribute__(opts.featName)
     score     = '0'
     rgb       = opts.rgb
@@ -125,7 +309,7 @@ def printBEDline(listOfRowsByFeature,opts):
     else:
         thkEnd    = chrmEnd
     
-    print '%s' % ('\t'.join([chrm,    
+    return '%s' % ('\t'.join([chrm,    
                              chrmStart,
                              chrmEnd,
                              name,
@@ -139,6 +323,56 @@ def printBEDline(listOfRowsByFeature,opts):
                              blkStarts]))
 
 
+def runConversion(tablePath,opts):
+    """Writes the track line and BED lines for <tablePath> to stdout.
+    With opts.progress, rows read and the time spent in each stage are
+    reported to stderr."""
+    started = time.time()
+    if opts.jobs > 1 and opts.sorted and not opts.ext_sort and \
+       os.path.isfile(tablePath) and not sniffCompression(tablePath):
+        # -- workers read their own byte ranges; nothing is parsed here --
+        print """track name=%s description="%s" useScore=0""" % (opts.track_name, opts.description)
+        sys.stdout.flush()
+        outFile = sys.stdout
+        if opts.progress:
+            outFile = InstrumentedWriter(sys.stdout,'write')
+        nRows = writeBEDrangesParallel(tablePath,opts,outFile,opts.jobs)
+        if opts.progress:
+            print >> sys.stderr, '%s rows read by %s workers' % (nRows,opts.jobs)
+            print >> sys.stderr, stageReport([outFile.stats],started)
+        return
+    # rows are streamed and block coords are converted to int once, here
+    coordTypes = {opts.blkChmStrt:int,opts.blkChmEnd:int}
+    if opts.ext_sort:
+        features = externalSortTable(tablePath,[opts.featName,opts.chrm],sep=opts.sep,types=coordTypes,
+                                     chunkRows=opts.chunk_rows,tmpDir=opts.tmp_dir)
+    else:
+        features = tableFile2namedTuple(tablePath,sep=opts.sep,lazy=True,types=coordTypes)
+    if opts.progress:
+        features = Instrumented(features,'rows',progress=True)
+    if opts.ext_sort or opts.sorted:
+        featureGroups = iterSortedFeatureGroups(features,opts)
+    else:
+        featureGroups = groupFeatureAlignments(features,opts).itervalues()
+    
+    print """track name=%s description="%s" useScore=0""" % (opts.track_name, opts.description)
+    sys.stdout.flush()
+    
+    outFile = sys.stdout
+    if opts.progress:
+        # -- busy time of each stage includes the stages it pulls from --
+        featureGroups = Instrumented(featureGroups,'features')
+        outFile = InstrumentedWriter(sys.stdout,'write')
+    
+    if opts.jobs > 1:
+        writeBEDlinesParallel(featureGroups,opts,outFile,opts.jobs)
+    else:
+        writeBEDlines(featureGroups,opts,outFile)
+    
+    if opts.progress:
+        print >> sys.stderr, stageReport([features.stats,featureGroups.stats,outFile.stats],started)
+
+
 if __name__ == "__main__":
     
     
@@ -171,8 +405,23 @@ if __name__ == "__main__":
                       help="""Exact Title of Column holding the cigar strings. Exp: cigar_string (default=%default)""")
     cigTypes = ['ensembl','exonerate']
     parser.add_option('--cigar-type',dest="cigar_type",type="str", default=False, 
-                      help="""Type of cigar string.  REQUIRED when using '--cigars'.  Options: %s (default=%default)""" % (cigTypes))
+                      help="""Type of cigar string.  REQUIRED when using '--cigars'.  Options: %s (default=%%default)""" % (cigTypes))
 
+    parser.add_option('--sorted',dest="sorted",action="store_true", default=False, 
+                      help="""Input rows are already grouped by feature (eg. sorted on featName,chrm): stream them one feature at a time instead of loading the whole table. (default=%default)""")
+    parser.add_option('--ext-sort',dest="ext_sort",action="store_true", default=False, 
+                      help="""Sort the input on featName,chrm with an on-disk merge sort, then stream it as with --sorted. For unsorted tables larger than RAM. (default=%default)""")
+    parser.add_option('--chunk-rows',dest="chunk_rows",type="int", default=1000000, 
+                      help="""Rows sorted in memory per temp file when using --ext-sort. (default=%default)""")
+    parser.add_option('--tmp-dir',dest="tmp_dir",type="str", default=None, 
+                      help="""Directory for --ext-sort temp files. (default=system temp dir)""")
+    parser.add_option('--jobs',dest="jobs",type="int", default=1, 
+                      help="""Number of processes used to build the BED lines. Output order is the same as with 1. With --sorted on a plain-text file each process also reads and parses its own part of the table; otherwise rows are still parsed by the main process, which limits the speedup. (default=%default)""")
+    
+    parser.add_option('--progress',dest="progress",action="store_true", default=False, 
+                      help="""Report rows read, MB and throughput to stderr while running, and per-stage timings at the end. (default=%default)""")
+    parser.add_option('--profile',dest="profile",type="str", default=None, 
+                      help="""Write cProfile and memory summaries of the run to PROFILE.prof and PROFILE.txt. (default=%default)""")
     
     (opts, args) = parser.parse_args()
     
@@ -181,11 +430,6 @@ if __name__ == "__main__":
         exit()
     
     
-    features   = tableFile2namedTuple(args[0],sep=opts.sep)
-    rowsByAlgn = groupFeatureAlignments(features,opts)
-    
-    print """track name=%s description="%s" useScore=0""" % (opts.track_name, opts.description)
-    
-    for alnmnt in rowsByAlgn:
-        printBEDline(rowsByAlgn[alnmnt],opts)
+    with maybeProfile(opts.profile):
+        runConversion(args[0],opts)
     
\ No newline at end of file
@@ -1,22 +1,321 @@
-import sys,optparse
+import os
+import re
+import sys
+import csv
+import zipfile
+import datetime
+import optparse
+import posixpath
+from xml.etree import cElementTree
 from scipherSrc.defs.files_io import xls2csv
+from scipherSrc.defs.instrument import Instrumented,maybeProfile
+
+# +++++ OOXML namespaces +++++
+_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_RELS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PKG  = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# -- builtin number formats that display dates/times --
+_DATE_FMT_IDS = set(range(14,23) + range(45,48))
+_DATE_CODE = re.compile(r'[dmyhs]', re.I)
+_QUOTED = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.')
+
+def _colIndex(ref):
+    """'AB12' -> 27 (0-based column of a cell reference)."""
+    col = 0
+    for ch in ref:
+        if 'A' <= ch <= 'Z':
+            col = col*26 + ord(ch) - 64
+        elif 'a' <= ch <= 'z':
+            col = col*26 + ord(ch) - 96
+        else:
+            break
+    return col - 1
+
+def _text(elem):
+    """Returns the text of a shared/inline string element, skipping the
+    phonetic (rPh) runs."""
+    parts = []
+    for child in elem:
+        if child.tag == _MAIN+'t':
+            parts.append(child.text or '')
+        elif child.tag == _MAIN+'r':
+            for t in child.iter(_MAIN+'t'):
+                parts.append(t.text or '')
+    return ''.join(parts)
+
+def _excelDate(value,date1904=False):
+    """Returns ISO str for an Excel serial date number (str)."""
+    serial = float(value)
+    if date1904:
+        base = datetime.datetime(1904,1,1)
+    else:
+        base = datetime.datetime(1899,12,30)
+    stamp = base + datetime.timedelta(days=serial)
+    if serial == int(serial):
+        return stamp.date().isoformat()
+    if serial < 1:
+        return stamp.time().isoformat()
+    return stamp.isoformat(' ')
+
+
+class XlsxReader(object):
+    """Streaming reader for .xlsx workbooks (zipped SpreadsheetML).
+    Only the shared strings table and the styles are held in memory; sheet
+    rows are parsed incrementally and yielded one at a time, so memory does
+    not grow with the number of rows.
+    Exmpl:
+        book = XlsxReader('export.xlsx')
+        for row in book.iterRows('Sheet1'):
+            ... row is list of str ...
+    """
+    def __init__(self,xlsxPath,dates=True):
+        """<dates>: convert date-formatted numbers to ISO strings."""
+        self.path = xlsxPath
+        self._zip = zipfile.ZipFile(xlsxPath)
+        self._sheets,self._date1904 = self._readWorkbook()
+        self._strings = None   # -- loaded on first use --
+        self._dates = dates
+        self._dateStyles = None
+
+    def _readWorkbook(self):
+        """Returns ([(sheetName,memberPath),...],date1904)."""
+        rels = {}
+        relsXml = cElementTree.fromstring(self._zip.read('xl/_rels/workbook.xml.rels'))
+        for rel in relsXml.iter(_PKG+'Relationship'):
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join('xl',target))
+            rels[rel.get('Id')] = target
+        book = cElementTree.fromstring(self._zip.read('xl/workbook.xml'))
+        sheets = [(s.get('name'),rels[s.get(_RELS+'id')]) for s in book.iter(_MAIN+'sheet')]
+        pr = book.find(_MAIN+'workbookPr')
+        date1904 = pr is not None and pr.get('date1904') in ('1','true')
+        return sheets,date1904
+
+    def _readSharedStrings(self):
+        if 'xl/sharedStrings.xml' not in self._zip.namelist():
+            return []
+        strings = []
+        for event,elem in cElementTree.iterparse(self._zip.open('xl/sharedStrings.xml')):
+            if elem.tag == _MAIN+'si':
+                strings.append(_text(elem))
+                elem.clear()
+        return strings
+
+    def _readDateStyles(self):
+        """Returns set of cell style (xf) indexes whose number format is a date."""
+        if 'xl/styles.xml' not in self._zip.namelist():
+            return set()
+        styles = cElementTree.fromstring(self._zip.read('xl/styles.xml'))
+        dateFmts = set(_DATE_FMT_IDS)
+        for fmt in styles.iter(_MAIN+'numFmt'):
+            code = _QUOTED.sub('', fmt.get('formatCode',''))
+            if _DATE_CODE.search(code):
+                dateFmts.add(int(fmt.get('numFmtId')))
+        cellXfs = styles.find(_MAIN+'cellXfs')
+        if cellXfs is None:
+            return set()
+        return set([i for i,xf in enumerate(cellXfs.findall(_MAIN+'xf'))
+                    if int(xf.get('numFmtId',0)) in dateFmts])
+
+    def sheetNames(self):
+        return [name for name,member in self._sheets]
+
+    def _sheetMember(self,sheet):
+        """<sheet> is a sheet name or 1-based int index."""
+        if isinstance(sheet,int) or (isinstance(sheet,str) and sheet.isdigit() and sheet not in self.sheetNames()):
+            i = int(sheet)
+            if not 1 <= i <= len(self._sheets):
+                raise Exception("**ERROR** %s has no sheet number %s." % (self.path,sheet))
+            return self._sheets[i-1][1]
+        for name,member in self._sheets:
+            if name == sheet:
+                return member
+        raise Exception("**ERROR** %s has no sheet named '%s'. Sheets: %s" % (self.path,sheet,self.sheetNames()))
+
+    def _cellValue(self,c):
+        kind = c.get('t','n')
+        if kind == 'inlineStr':
+            inline = c.find(_MAIN+'is')
+            return _text(inline) if inline is not None else ''
+        v = c.find(_MAIN+'v')
+        if v is None or v.text is None:
+            return ''
+        value = v.text
+        if kind == 's':
+            return self._strings[int(value)]
+        if kind == 'b':
+            return 'TRUE' if value == '1' else 'FALSE'
+        if kind == 'n' and self._dateStyles and int(c.get('s',0)) in self._dateStyles:
+            try:
+                return _excelDate(value,self._date1904)
+            except (ValueError,OverflowError):
+                return value
+        return value
+
+    def iterRows(self,sheet=1):
+        """Yields each row of <sheet> (name or 1-based index) as a list of
+        str.  Gaps left by empty cells/rows are filled with '' / [] so
+        columns and line numbers match the sheet."""
+        member = self._sheetMember(sheet)
+        if self._strings is None:
+            self._strings = self._readSharedStrings()
+            self._dateStyles = self._readDateStyles() if self._dates else set()
+        rowNum = 0
+        sheetData = None
+        for event,elem in cElementTree.iterparse(self._zip.open(member), events=('start','end')):
+            if event == 'start':
+                if elem.tag == _MAIN+'sheetData':
+                    sheetData = elem
+                continue
+            if elem.tag != _MAIN+'row':
+                continue
+            r = elem.get('r')
+            if r is not None:
+                while rowNum < int(r) - 1:
+                    rowNum += 1
+                    yield []
+            rowNum += 1
+            row = []
+            for c in elem.iter(_MAIN+'c'):
+                ref = c.get('r')
+                if ref is not None:
+                    col = _colIndex(ref)
+                    if col > len(row):
+                        row.extend([''] * (col - len(row)))
+                row.append(self._cellValue(c))
+            yield row
+            # -- drop finished rows so the tree never holds more than one --
+            if sheetData is not None:
+                sheetData.clear()
+            else:
+                elem.clear()
+
+    def close(self):
+        self._zip.close()
+
+
+def _encode(row):
+    return [x.encode('utf-8') if isinstance(x,unicode) else x for x in row]
+
+def xlsx2csv(xlsxPath,csvPath=None,sheet=1,sep=',',batchRows=10000,progress=False):
+    """Converts <sheet> of <xlsxPath> to <csvPath> (stdout if None) with a
+    csv.writer, writing rows in batches of <batchRows>.
+    <progress>: report rows converted and throughput to stderr.
+    Returns number of rows written."""
+    book = XlsxReader(xlsxPath)
+    if csvPath is None:
+        outFile = sys.stdout
+    else:
+        outFile = open(csvPath, 'wb')
+    writer = csv.writer(outFile, delimiter=sep, lineterminator='\n')
+    count = 0
+    batch = []
+    rows = book.iterRows(sheet)
+    if progress:
+        rows = Instrumented(rows,'%s:%s' % (os.path.basename(xlsxPath),sheet),progress=True,timeStages=False)
+    for row in rows:
+        batch.append(_encode(row))
+        if len(batch) >= batchRows:
+            writer.writerows(batch)
+            count += len(batch)
+            batch = []
+    writer.writerows(batch)
+    count += len(batch)
+    if csvPath is not None:
+        outFile.close()
+    book.close()
+    return count
+
+def _convertJob(job):
+    """Pool worker: job is (xlsxPath,sheet,csvPath,sep[,progress])."""
+    return job[2],xlsx2csv(job[0],job[2],job[1],job[3],progress=len(job) > 4 and job[4])
+
+def convertMany(jobs,processes=None):
+    """Runs the (xlsxPath,sheet,csvPath,sep[,progress]) conversions in <jobs>
+    in a pool of <processes> workers.  Returns list of (csvPath,rowCount)."""
+    if processes == 1 or len(jobs) <= 1:
+        return map(_convertJob,jobs)
+    import multiprocessing
+    pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(),len(jobs)))
+    try:
+        results = pool.map(_convertJob,jobs)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def _outName(xlsxPath,sheet,outDir,oneSheet):
+    base = os.path.splitext(os.path.basename(xlsxPath))[0]
+    if not oneSheet:
+        base = '%s.%s' % (base,re.sub(r'[^\w.-]+','_',str(sheet)))
+    return os.path.join(outDir,base + '.csv')
+
 def main():
-    usage = """python %prog [options] xlsPath [outPath]"""
+    usage = """python %prog [options] xlsPath [outPath]
+       python %prog [options] --out-dir DIR xlsPath [xlsPath ...]"""
     parser = optparse.OptionParser(usage)
-    parser.add_option('-d','--delim',type="str", default=",", 
+    parser.add_option('-d','--delim',type="str", default=",",
                       help="""The text deleminator you wish to use. (default=%default)""")
-    
+    parser.add_option('-s','--sheet',dest="sheets",type="str", action="append", default=None,
+                      help="""Sheet name or 1-based number to convert; repeat for more sheets. (default=first sheet)""")
+    parser.add_option('-a','--all-sheets',dest="allSheets",action="store_true", default=False,
+                      help="""Convert every sheet. (default=%default)""")
+    parser.add_option('-o','--out-dir',dest="outDir",type="str", default=None,
+                      help="""Write one csv per file/sheet here, named <xls>.csv or <xls>.<sheet>.csv. (default=%default)""")
+    parser.add_option('-j','--jobs',dest="jobs",type="int", default=1,
+                      help="""Number of sheets/files to convert at once. (default=%default)""")
+    parser.add_option('-l','--list-sheets',dest="listSheets",action="store_true", default=False,
+                      help="""Print the sheet names of each xlsPath and exit. (default=%default)""")
+
+    parser.add_option('--progress',dest="progress",action="store_true", default=False,
+                      help="""Report rows converted and throughput to stderr while running. (default=%default)""")
+    parser.add_option('--profile',dest="profile",type="str", default=None,
+                      help="""Write cProfile and memory summaries of the run to PROFILE.prof and PROFILE.txt (workers started by --jobs are not profiled). (default=%default)""")
+
     (opts, args) = parser.parse_args()
-        
+
     if len(sys.argv[1:]) == 0:
         parser.print_help()
         exit(0)
     if not len(args) >= 1:
         raise Exception("**ERROR: you must supply at least an xlsPath.**")
-    if len(args) == 1:
-        args.append(None)
-        
-    xls2csv(args[0],args[1],sep=opts.delim)
-    
+
+    if opts.listSheets:
+        for path in args:
+            print '%s\t%s' % (path,'\t'.join(XlsxReader(path,dates=False).sheetNames()))
+        return
+
+    if opts.outDir is None:
+        # -- original form: xlsPath [outPath] --
+        if len(args) > 2 or opts.allSheets or (opts.sheets and len(opts.sheets) > 1):
+            raise Exception("**ERROR: use --out-dir to convert more than one file or sheet.**")
+        if len(args) == 1:
+            args.append(None)
+        if not zipfile.is_zipfile(args[0]):
+            # -- not a workbook: treat as a delimited text export --
+            xls2csv(args[0],args[1],sep=opts.delim)
+            return
+        with maybeProfile(opts.profile):
+            xlsx2csv(args[0],args[1],(opts.sheets or [1])[0],opts.delim,progress=opts.progress)
+        return
+
+    jobs = []
+    for path in args:
+        if opts.allSheets:
+            sheets = XlsxReader(path,dates=False).sheetNames()
+        else:
+            sheets = opts.sheets or [1]
+        for sheet in sheets:
+            jobs.append((path,sheet,_outName(path,sheet,opts.outDir,len(sheets) == 1),opts.delim,opts.progress))
+    with maybeProfile(opts.profile):
+        results = convertMany(jobs,opts.jobs)
+    for csvPath,count in results:
+        print >> sys.stderr, '%s\t%s rows' % (csvPath,count)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()